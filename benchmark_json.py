@@ -0,0 +1,93 @@
+import argparse
+import glob
+import os
+import random
+import time
+
+from slacker import JsonCodec, orjson
+
+# Measures how fast each JSON backend parses and writes Slack messages, in the
+# formats slack_export.py writes. Reads the day files of an export when one is
+# given, and uses synthetic messages otherwise.
+#
+#   python benchmark_json.py [EXPORT_DIRECTORY] [--repeat N]
+
+def syntheticDays(days=200, messagesPerDay=100):
+    rng = random.Random(0)
+    words = ['deploy', 'review', 'merge', 'ticket', 'build', 'release', 'café', 'naïve', '✅', '🎉']
+    startTime = 1600000000
+    documents = []
+    for day in range(days):
+        messages = []
+        for number in range(messagesPerDay):
+            ts = '%d.%06d' % (startTime + day * 86400 + number * 60, number)
+            text = ' '.join(rng.choice(words) for _ in range(rng.randint(5, 40)))
+            message = {
+                'type': 'message', 'user': 'U%07d' % rng.randint(0, 50), 'text': text, 'ts': ts,
+                'blocks': [{'type': 'rich_text', 'block_id': 'b%d' % number, 'elements': [
+                    {'type': 'rich_text_section', 'elements': [{'type': 'text', 'text': text}]}]}],
+                'team': 'T0000001', 'client_msg_id': '%032x' % rng.getrandbits(128),
+            }
+            if number % 7 == 0:
+                message['reactions'] = [{'name': 'thumbsup', 'users': ['U0000001', 'U0000002'], 'count': 2}]
+            if number % 23 == 0:
+                message['files'] = [{'id': 'F%08d' % number, 'name': 'image.png', 'mimetype': 'image/png',
+                                     'size': rng.randint(1000, 10 ** 7),
+                                     'url_private': 'https://files.slack.com/files-pri/T1-F%08d/image.png' % number}]
+            messages.append(message)
+        documents.append(JsonCodec('json').dumps(messages, indent=4))
+    return documents
+
+
+def exportDays(directory):
+    documents = []
+    for fileName in sorted(glob.glob(os.path.join(directory, '*', '*.json'))):
+        with open(fileName) as inFile:
+            documents.append(inFile.read())
+    return documents
+
+
+def throughput(function, items, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        size = sum(len(result) if isinstance(result, str) else 0 for result in map(function, items))
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return size, best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the JSON backends of slack_export.py')
+    parser.add_argument('directory', nargs='?', help="An export directory to read day files from")
+    parser.add_argument('--repeat', type=int, default=3, help="Runs per measurement, the best one counts")
+    args = parser.parse_args()
+
+    documents = exportDays(args.directory) if args.directory else syntheticDays()
+    inputBytes = sum(len(document.encode('utf-8')) for document in documents)
+    print("{0} day files, {1:.1f} MB".format(len(documents), inputBytes / (1024 * 1024)))
+
+    backends = ['json'] + (['orjson'] if orjson is not None else [])
+    if orjson is None:
+        print("orjson is not installed, only the standard library is measured")
+
+    parsed = [JsonCodec('json').loads(document) for document in documents]
+    print("{0:<28} {1:>10} {2:>10}".format("", "MB", "MB/s"))
+    for backend in backends:
+        codec = JsonCodec(backend)
+        _, seconds = throughput(codec.loads, documents, args.repeat)
+        print("{0:<28} {1:>10.1f} {2:>10.1f}".format(
+            "parse, " + backend, inputBytes / (1024 * 1024), inputBytes / (1024 * 1024) / seconds))
+
+    for backend in backends:
+        for compatible in ((True, False) if backend == 'orjson' else (True,)):
+            codec = JsonCodec(backend, compatible)
+            for format, indent in (('viewer', 4), ('compact', None)):
+                size, seconds = throughput(lambda messages: codec.dumps(messages, indent), parsed, args.repeat)
+                label = "write {0}, {1}{2}".format(format, backend, "" if compatible else " (fast)")
+                print("{0:<28} {1:>10.1f} {2:>10.1f}".format(
+                    label, size / (1024 * 1024), size / (1024 * 1024) / seconds))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,36 +1,112 @@
+import io
 import json
 import argparse
+import bisect
+import fnmatch
+import hashlib
+import heapq
+import itertools
+import lzma
 import os
+import queue
 import shutil
+import sqlite3
 import sys
-from datetime import datetime
-from typing import Any, Callable, List, Mapping, MutableMapping, Optional
+import tarfile
+import tempfile
+import threading
+import time
+import zipfile
+import zlib
+import zoneinfo
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Iterator, List, Mapping, MutableMapping, NamedTuple, Optional, Tuple
 from pick import pick
 from time import sleep
 from urllib.parse import urlparse
 import requests
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
 from slacker import *
+from slacker import DEFAULT_POOL_MAXSIZE, DEFAULT_TIMEOUT, RETRY_STATUSES
 
 ##################################################################
 
 noop = lambda *args, **kwargs: None
 
+# maximum number of threads whose replies are fetched at the same time, by
+# the reply pool that all conversations share
+threadWorkers = 8
+replyPool = None
+# maximum number of conversations exported at the same time
+exportWorkers = 4
+# number of files downloaded at the same time, and their combined bandwidth cap
+downloadWorkers = 8
+downloadBytesPerSecond = None
+# set when --downloadSlackFiles is given
+fileDownloader = None
+# set when --blobStore is given
+blobStore = None
+# decides which files and thumbnails --downloadSlackFiles downloads
+filePolicy = None
+# conversations are sorted before they are written, spilling sorted runs to
+# disk once this many messages or bytes are buffered; None streams them instead
+spillMessages = None
+spillBytes = None
+spillDirectory = None
+# set when --zip or --tar writes the export straight into an archive
+archive = None
+# conversations written to an archive or to a single JSON Lines file are
+# sorted first, spilling past this many messages unless
+# --spillMessages/--spillMegabytes say otherwise
+sortSpillMessages = 100000
+# how files are written: 'viewer' (indented JSON day files, as Slack's own
+# export), 'compact' JSON day files, 'jsonl' (a message per line) day files,
+# or 'jsonl-conversation' (a message per line, one file per conversation)
+outputFormats = ('viewer', 'compact', 'jsonl', 'jsonl-conversation')
+outputFormat = 'viewer'
+# parses API responses and serializes/parses everything the export writes
+jsonCodec = JsonCodec()
+# set when --sqlite is given
+sqliteExport = None
+# set when --parquet is given
+parquetExport = None
+# writes day files in the background, None writes them on the fetching thread
+writerThreads = 2
+writerPool = None
+# --tar compression, done in blocks on this many threads
+archiveCompression = None
+compressionLevel = None
+compressionWorkers = None
+
+def messageTimeStamp(message):
+    return message['ts']
+
 def getCursor(response: Mapping) -> Optional[str]:
     metadata = response.get('response_metadata')
     if metadata:
         return metadata.get('next_cursor')
     return None
 
-def paginatedRequest(
+# yields (items, next cursor) for every page of a paginated API method
+def iterPages(
   getResponse: Callable[[Optional[str], int], MutableMapping[str, Any]],
   itemsKey: str,
-  processItemPage: Callable[[List[MutableMapping[str, Any]]], None] = noop,
-  pageSize: int = 200
-) -> List[MutableMapping[str, Any]]:
-    items = []
-    cursor = None
-
+  pageSize: int = 200,
+  cursor: Optional[str] = None
+) -> Iterator[Tuple[List[MutableMapping[str, Any]], Optional[str]]]:
     while (cursor != ""):
         response = None
 
@@ -46,66 +122,727 @@ def paginatedRequest(
                 else:
                     raise
 
-        returned_items = response[itemsKey]
-        items.extend(returned_items)
         cursor = getCursor(response)
-
-        processItemPage(returned_items)
+        yield response[itemsKey], cursor
 
         if cursor is None: # No pagination as fewer than pageSize items
             break
 
+def paginatedRequest(
+  getResponse: Callable[[Optional[str], int], MutableMapping[str, Any]],
+  itemsKey: str,
+  processItemPage: Callable[[List[MutableMapping[str, Any]]], None] = noop,
+  pageSize: int = 200,
+  cursor: Optional[str] = None
+) -> List[MutableMapping[str, Any]]:
+    items = []
+
+    for returned_items, cursor in iterPages(getResponse, itemsKey, pageSize, cursor):
+        items.extend(returned_items)
+        processItemPage(returned_items)
+
     return items
 
-# fetches the complete message history for a channel/group/im
+# Durable record of the export's progress, kept inside the output directory so
+# that an interrupted export can be picked up again with --resume.
+#
+# The journal is a JSON Lines file with one record per fetched history page
+# ({"id": ..., "pages": n, "cursor": ..., "offset": ...}) and per finished
+# conversation ({"id": ..., "done": true}). The messages of every page (with
+# their thread replies) are appended to a spool file per conversation, so a
+# resumed export carries on from the last cursor without fetching those pages
+# again.
+#
+# A page is appended to the spool before its journal record, which holds the
+# size of the spool after it. A crash can leave a torn record at the end of
+# the journal, and lines at the end of a spool that no record accounts for,
+# whole or torn. Both files are cut back to their last good record when the
+# journal is loaded, so nothing is appended after such leftovers.
 #
-# pageableObject could be:
-# slack.channel
-# slack.groups
-# slack.im
+# Pages are saved on the writer threads, all pages of a conversation on the
+# same one so they stay in order, and a conversation is only marked done once
+# they are all saved.
+class CheckpointJournal:
+    fileName = '.checkpoint.jsonl'
+    spoolDirectory = '.checkpoint'
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.done = set()
+        self.progress = {}
+        self.pending = {}
+
+        if os.path.exists(self.fileName):
+            goodBytes = 0
+            with open(self.fileName, 'rb') as journal:
+                for line in journal:
+                    try:
+                        if not line.endswith(b'\n'):
+                            raise ValueError("no end of line")
+                        record = jsonCodec.loads(line)
+                    except ValueError:
+                        break  # torn final record from the interrupted run
+                    goodBytes += len(line)
+                    if record.get('done'):
+                        self.done.add(record['id'])
+                        self.progress.pop(record['id'], None)
+                    else:
+                        self.progress[record['id']] = record
+            os.truncate(self.fileName, goodBytes)
+
+        if os.path.isdir(self.spoolDirectory):
+            for name in os.listdir(self.spoolDirectory):
+                self.restoreSpool(name[:-len('.jsonl')])
+        self.progress = {conversationId: record for conversationId, record in self.progress.items()
+                         if os.path.exists(self.spoolFile(conversationId))}
+
+        self.journal = open(self.fileName, 'ab')
+
+    def spoolFile(self, conversationId):
+        return os.path.join(self.spoolDirectory, conversationId + '.jsonl')
+
+    # cuts the spool of a conversation back to the size its last journal
+    # record saw; a spool shorter than that can't be trusted, and its
+    # conversation starts from scratch
+    def restoreSpool(self, conversationId):
+        spoolFile = self.spoolFile(conversationId)
+        record = self.progress.get(conversationId)
+        if record is not None and os.path.getsize(spoolFile) >= record['offset']:
+            os.truncate(spoolFile, record['offset'])
+            return
+        self.progress.pop(conversationId, None)
+        os.remove(spoolFile)
+
+    # appends a line of JSON and returns the size of outFile after it
+    def append(self, outFile, line):
+        outFile.write((line + '\n').encode('utf-8'))
+        outFile.flush()
+        os.fsync(outFile.fileno())
+        return outFile.tell()
+
+    def isDone(self, conversationId):
+        return conversationId in self.done
+
+    # returns the cursor to continue a conversation from: None to start from
+    # scratch, "" if all of its pages have been fetched already
+    def resumeCursor(self, conversationId):
+        record = self.progress.get(conversationId)
+        return record['cursor'] if record else None
+
+    # yields the pages already fetched for a conversation
+    def restorePages(self, conversationId):
+        record = self.progress.get(conversationId)
+        if record is None:
+            return
+
+        with open(self.spoolFile(conversationId), 'rb') as spool:
+            for pageNumber, line in zip(range(record['pages']), spool):
+                yield jsonCodec.loads(line)
+
+    # saves a page on a writer thread; the page is serialized right away,
+    # before the day file writers point its file links at local copies
+    def submitPage(self, conversationId, messages, cursor):
+        write = submitTask(self.spoolFile(conversationId), self.appendPage,
+                           conversationId, jsonCodec.dumps(messages), cursor)
+        with self.lock:
+            self.pending.setdefault(conversationId, []).append(write)
+
+    def appendPage(self, conversationId, line, cursor):
+        mkdir(self.spoolDirectory)
+        with open(self.spoolFile(conversationId), 'ab') as spool:
+            offset = self.append(spool, line)
+
+        with self.lock:
+            record = self.progress.get(conversationId, {'id': conversationId, 'pages': 0})
+            record = dict(record, pages=record['pages'] + 1, cursor=cursor or "", offset=offset)
+            self.progress[conversationId] = record
+            self.append(self.journal, jsonCodec.dumps(record))
+
+    def markDone(self, conversationId):
+        with self.lock:
+            writes = self.pending.pop(conversationId, [])
+        waitForWrites(writes)
+        with self.lock:
+            self.done.add(conversationId)
+            self.progress.pop(conversationId, None)
+            self.append(self.journal, jsonCodec.dumps({'id': conversationId, 'done': True}))
+        if os.path.exists(self.spoolFile(conversationId)):
+            os.remove(self.spoolFile(conversationId))
+
+    # called once the export is complete; the journal is of no further use
+    def remove(self):
+        self.journal.close()
+        os.remove(self.fileName)
+        shutil.rmtree(self.spoolDirectory, ignore_errors=True)
+
+
+# The newest 'ts' exported for each conversation, kept in the output directory
+# so that an --incremental export only asks Slack for newer messages, and the
+# directory its day files are in, so that they can be moved along when the
+# conversation is renamed.
+class HighWaterMarks:
+    fileName = '.export-state.json'
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.marks = {}
+        if os.path.exists(self.fileName):
+            with open(self.fileName) as inFile:
+                self.marks = json.load(inFile)
+
+    def get(self, conversationId):
+        return self.marks.get(conversationId, {}).get('ts')
+
+    def directory(self, conversationId):
+        return self.marks.get(conversationId, {}).get('directory')
+
+    # records a newer 'ts' and/or the directory of a conversation, until the
+    # next save
+    def update(self, conversationId, timeStamp=None, directory=None):
+        with self.lock:
+            mark = self.marks.setdefault(conversationId, {})
+            if timeStamp is not None:
+                mark['ts'] = timeStamp
+            if directory is not None:
+                mark['directory'] = directory
+
+    def save(self):
+        with self.lock:
+            # write a new file and swap it in, so a crash never leaves half a state file
+            with open(self.fileName + '.tmp', 'w') as outFile:
+                json.dump(self.marks, outFile, indent=4, sort_keys=True)
+            os.replace(self.fileName + '.tmp', self.fileName)
+
+
+# returns the newest 'ts' among messages that came from conversations.history.
+# Thread replies are left out: they can be newer than top-level messages that
+# have not been fetched yet.
+def newestTopLevelTimeStamp(messages):
+    topLevel = [message['ts'] for message in messages
+                if message.get('thread_ts', message['ts']) == message['ts']
+                or message.get('subtype') == 'thread_broadcast']
+    return max(topLevel, key=float, default=None)
+
+
+# fetches the replies of every thread started on a page of history in
+# parallel, returning all of them as a single list ordered by 'ts'
+def getThreadReplies(channelId, messages, pageSize=200):
+    # only thread parents have thread_ts == ts; broadcast replies point at a
+    # parent that is fetched on its own
+    threadTimeStamps = [message['ts'] for message in messages
+                        if message.get('thread_ts') == message['ts']]
+    if not threadTimeStamps:
+        return []
+
+    # reply tasks never submit more work to the pool, so sharing it between
+    # conversations can't deadlock
+    if replyPool is None:
+        threads = [getHistory(channelId, thread_ts, pageSize) for thread_ts in threadTimeStamps]
+    else:
+        threads = list(replyPool.map(
+            lambda thread_ts: getHistory(channelId, thread_ts, pageSize),
+            threadTimeStamps))
+
+    return list(heapq.merge(*threads, key=messageTimeStamp))
+
+# yields the message history of a channel/group/im one page at a time, newest
+# page first. Each page comes with the replies to the threads started on it,
+# the whole batch sorted by 'ts'. Every reply is newer than its thread's
+# parent, so the first message of a batch is also the oldest of its page.
 #
-# channelId is the id of the channel/group/im you want to download history for.
+# With a checkpoint, pages fetched by an interrupted run are replayed from the
+# spool and fetching continues from the saved cursor.
 
-def getHistory(channelId, thread_ts=None, pageSize=200):
+def iterHistory(channelId, pageSize=200, checkpoint=None, oldest=None):
     def getResponse(cursor: Optional[str], pageSize: int) -> MutableMapping:
-        if (thread_ts is None):
-            return slack.conversations.history(
-                channel=channelId,
-                cursor=cursor,
-                limit=pageSize
-            ).body
-        else:
-            return slack.conversations.replies(
-                channel=channelId,
-                ts=thread_ts,
-                cursor=cursor,
-                limit=pageSize,
-            ).body
-
-    def processItemPage(items: List[MutableMapping]) -> None:
-        if (thread_ts is None):
-            # Grab all replies
-            for message in items:
-                if "thread_ts" in message:
-                    # sleep(0.5)  # INSERT LIMIT
-                    items.extend(getHistory(channelId, message["thread_ts"], pageSize))
+        return slack.conversations.history(
+            channel=channelId,
+            cursor=cursor,
+            limit=pageSize,
+            oldest=oldest
+        ).body
+
+    cursor = None
+    if checkpoint is not None:
+        cursor = checkpoint.resumeCursor(channelId)
+        yield from checkpoint.restorePages(channelId)
+        if cursor == "":
+            return
+
+    for page, cursor in iterPages(getResponse, 'messages', pageSize, cursor):
+        batch = list(heapq.merge(
+            sorted(page, key=messageTimeStamp),
+            getThreadReplies(channelId, page, pageSize),
+            key=messageTimeStamp))
+        if checkpoint is not None:
+            checkpoint.submitPage(channelId, batch, cursor)
 
         sys.stdout.write(".")
         sys.stdout.flush()
-        # sleep(1.3)  # Respect the Slack API rate limit
+        yield batch
 
-    messages = paginatedRequest(getResponse, 'messages', processItemPage)
+# fetches the replies of the thread started at thread_ts
+#
+# channelId is the id of the channel/group/im the thread is in.
 
-    messages.sort(key=lambda message: message['ts'])
+def getHistory(channelId, thread_ts, pageSize=200):
+    def getResponse(cursor: Optional[str], pageSize: int) -> MutableMapping:
+        return slack.conversations.replies(
+            channel=channelId,
+            ts=thread_ts,
+            cursor=cursor,
+            limit=pageSize,
+        ).body
 
-    if (thread_ts is not None):
-        # Obtaining replies also gives us the first message in the the thread
-        # (which we don't want) -- after sorting, our first message with the be the
-        # first in the list of all messages, so we remove the head of the list
-        assert messages[0]["ts"] == thread_ts, "unexpected start of thread"
-        messages = messages[1:]
+    messages = paginatedRequest(getResponse, 'messages', pageSize=pageSize)
+    messages.sort(key=messageTimeStamp)
+
+    # Obtaining replies also gives us the first message in the the thread
+    # (which we don't want) -- after sorting, our first message with the be the
+    # first in the list of all messages, so we remove the head of the list
+    assert messages[0]["ts"] == thread_ts, "unexpected start of thread"
+    return messages[1:]
+
+
+# Sorts the messages of a conversation by 'ts' without holding them all in
+# memory. Messages are buffered as serialized JSON; once the buffer passes
+# maxMessages or maxBytes it is sorted and written to a temporary file as a
+# run. sortedMessages() then k-way merges the runs with what is still buffered.
+class ExternalSorter:
+    def __init__(self, maxMessages=None, maxBytes=None, directory=None):
+        self.maxMessages = maxMessages
+        self.maxBytes = maxBytes
+        self.directory = directory
+        self.buffer = []
+        self.bufferBytes = 0
+        self.runs = []
+        self.temporaryDirectory = None
+
+    def add(self, messages):
+        for message in messages:
+            line = jsonCodec.dumps(message)
+            self.buffer.append((message['ts'], line))
+            self.bufferBytes += len(line)
+
+        if ((self.maxMessages is not None and len(self.buffer) >= self.maxMessages) or
+                (self.maxBytes is not None and self.bufferBytes >= self.maxBytes)):
+            self.spill()
+
+    def spill(self):
+        if self.temporaryDirectory is None:
+            if self.directory is not None:
+                mkdir(self.directory)
+            self.temporaryDirectory = tempfile.mkdtemp(prefix='slack_export-', dir=self.directory)
+        self.buffer.sort(key=lambda entry: entry[0])
+        runFile = os.path.join(self.temporaryDirectory, '{0}.jsonl'.format(len(self.runs)))
+        with open(runFile, 'w', encoding='utf-8') as outFile:
+            for timeStamp, line in self.buffer:
+                outFile.write(timeStamp + '\t' + line + '\n')
+        self.runs.append(runFile)
+        self.buffer = []
+        self.bufferBytes = 0
+
+    def readRun(self, runFile):
+        with open(runFile, encoding='utf-8') as inFile:
+            for line in inFile:
+                timeStamp, _, message = line.partition('\t')
+                yield timeStamp, message
+
+    def sortedMessages(self):
+        try:
+            self.buffer.sort(key=lambda entry: entry[0])
+            runs = [self.readRun(runFile) for runFile in self.runs] + [self.buffer]
+            for timeStamp, line in heapq.merge(*runs, key=lambda entry: entry[0]):
+                yield jsonCodec.loads(line)
+        finally:
+            self.buffer = []
+            if self.temporaryDirectory is not None:
+                shutil.rmtree(self.temporaryDirectory, ignore_errors=True)
+
+
+def compressBlock(codec, level, data):
+    started = time.monotonic()
+    if codec == 'gz':
+        # wbits 31 makes a complete gzip member
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+        compressed = compressor.compress(data) + compressor.flush()
+    elif codec == 'xz':
+        compressed = lzma.compress(data, preset=level)
+    else:
+        compressed = zstandard.ZstdCompressor(level=level).compress(data)
+    return compressed, time.monotonic() - started
+
+
+# A write-only file object that compresses what is written to it in blocks on
+# a pool of threads, and writes the compressed blocks to fileName in order.
+# Each block is a complete gzip member, xz stream or zstd frame, and gzip, xz
+# and zstd read such a concatenation as a single stream. zlib, lzma and
+# zstandard release the GIL while compressing, so the blocks are compressed
+# on all cores.
+class ParallelCompressor:
+    blockSize = 4 * 1024 * 1024
+    levels = {'gz': 6, 'xz': 6, 'zstd': 3}
+
+    def __init__(self, fileName, codec, level=None, workers=None):
+        self.outFile = open(fileName, 'wb')
+        self.codec = codec
+        self.level = level if level is not None else self.levels[codec]
+        self.workers = workers or os.cpu_count() or 1
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        self.buffer = bytearray()
+        self.pending = deque()
+        self.bytesIn = 0
+        self.bytesOut = 0
+        self.compressSeconds = 0.0
+        # wall clock time during which at least one block was being compressed
+        self.lock = threading.Lock()
+        self.active = 0
+        self.busySince = None
+        self.busySeconds = 0.0
+
+    def write(self, data):
+        self.buffer += data
+        self.bytesIn += len(data)
+        if len(self.buffer) >= self.blockSize:
+            self.submit()
+        return len(data)
+
+    def submit(self):
+        block = bytes(self.buffer)
+        self.buffer = bytearray()
+        self.pending.append(self.executor.submit(self.compress, block))
+        # at most two blocks per thread are held in memory
+        while len(self.pending) > self.workers * 2:
+            self.writeBlock()
+
+    def compress(self, block):
+        with self.lock:
+            if self.active == 0:
+                self.busySince = time.monotonic()
+            self.active += 1
+        try:
+            return compressBlock(self.codec, self.level, block)
+        finally:
+            with self.lock:
+                self.active -= 1
+                if self.active == 0:
+                    self.busySeconds += time.monotonic() - self.busySince
+
+    def writeBlock(self):
+        compressed, seconds = self.pending.popleft().result()
+        self.outFile.write(compressed)
+        self.bytesOut += len(compressed)
+        self.compressSeconds += seconds
+
+    def close(self):
+        if self.buffer:
+            self.submit()
+        while self.pending:
+            self.writeBlock()
+        self.executor.shutdown()
+        self.outFile.close()
+
+    def report(self):
+        return {'bytes_in': self.bytesIn, 'bytes_out': self.bytesOut,
+                'compress_seconds': self.compressSeconds, 'busy_seconds': self.busySeconds,
+                'workers': self.workers}
+
+
+# Writes the export straight into a zip or tar file as it is produced, so no
+# directory tree has to be written, read back to be compressed and deleted.
+# Entries are added from any thread, a lock keeps them whole. Nothing in an
+# archive can be rewritten, so every file must be written exactly once.
+class ExportArchive:
+    extensions = {'zip': '.zip', 'tar': '.tar', 'gz': '.tar.gz', 'xz': '.tar.xz', 'zstd': '.tar.zst'}
+
+    def __init__(self, baseName, format, compression=None, level=None, workers=None):
+        self.fileName = baseName + self.extensions[compression or format]
+        self.format = format
+        self.lock = threading.Lock()
+        self.compressor = None
+        if format == 'zip':
+            self.archive = zipfile.ZipFile(self.fileName, 'w', zipfile.ZIP_DEFLATED)
+        elif compression:
+            self.compressor = ParallelCompressor(self.fileName, compression, level, workers)
+            self.archive = tarfile.open(fileobj=self.compressor, mode='w|')
+        else:
+            self.archive = tarfile.open(self.fileName, 'w')
+
+    def write(self, name, text):
+        data = text.encode('utf-8')
+        with self.lock:
+            if self.format == 'zip':
+                info = zipfile.ZipInfo(name, time.localtime()[:6])
+                info.compress_type = zipfile.ZIP_DEFLATED
+                info.external_attr = 0o644 << 16
+                self.archive.writestr(info, data)
+            else:
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                info.mtime = int(time.time())
+                info.mode = 0o644
+                self.archive.addfile(info, io.BytesIO(data))
+
+    # adds the files and directories under directory, e.g. the export's state files
+    def addTree(self, directory):
+        with self.lock:
+            for root, dirNames, fileNames in os.walk(directory):
+                dirNames.sort()
+                for name in dirNames + sorted(fileNames):
+                    path = os.path.join(root, name)
+                    arcName = os.path.relpath(path, directory)
+                    if self.format == 'zip':
+                        self.archive.write(path, arcName)
+                    else:
+                        self.archive.add(path, arcName, recursive=False)
+
+    def close(self):
+        with self.lock:
+            self.archive.close()
+            if self.compressor is not None:
+                self.compressor.close()
+
+
+def openArchive():
+    return ExportArchive(os.path.abspath(archiveName), archiveFormat, archiveCompression,
+                         compressionLevel, compressionWorkers)
+
+
+# Writes messages, users, channels and file references to a SQLite database
+# next to the regular output, so they can be queried instead of grepped.
+# Messages are upserted on (channel, ts), which makes resumed and incremental
+# exports idempotent, and are inserted in batches of batchSize rows per
+# transaction. The database is in WAL mode, with indexes on (channel, ts),
+# user and thread_ts, and messages_fts, an FTS5 index on the message text that
+# triggers keep in sync, e.g.
+#
+#   SELECT channel, ts, text FROM messages
+#   WHERE rowid IN (SELECT rowid FROM messages_fts WHERE messages_fts MATCH 'deploy');
+class SQLiteExport:
+    batchSize = 5000
+    schema = """
+        CREATE TABLE IF NOT EXISTS users (
+            id TEXT PRIMARY KEY, name TEXT, real_name TEXT, json TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS channels (
+            id TEXT PRIMARY KEY, name TEXT, type TEXT, json TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS messages (
+            channel TEXT NOT NULL, ts TEXT NOT NULL, user TEXT, thread_ts TEXT,
+            subtype TEXT, text TEXT, json TEXT NOT NULL);
+        CREATE UNIQUE INDEX IF NOT EXISTS messages_channel_ts ON messages (channel, ts);
+        CREATE INDEX IF NOT EXISTS messages_user ON messages (user);
+        CREATE INDEX IF NOT EXISTS messages_thread_ts ON messages (thread_ts);
+        CREATE TABLE IF NOT EXISTS files (
+            id TEXT NOT NULL, channel TEXT NOT NULL, ts TEXT NOT NULL, name TEXT,
+            mimetype TEXT, size INTEGER, url_private TEXT, PRIMARY KEY (id, channel, ts));
+        CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+            text, content='messages', content_rowid='rowid');
+        CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+            INSERT INTO messages_fts (rowid, text) VALUES (new.rowid, new.text);
+        END;
+        CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, text) VALUES ('delete', old.rowid, old.text);
+        END;
+        CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE ON messages BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, text) VALUES ('delete', old.rowid, old.text);
+            INSERT INTO messages_fts (rowid, text) VALUES (new.rowid, new.text);
+        END;
+    """
 
-    return messages
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(fileName, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript(self.schema)
+        self.messages = []
+        self.files = []
+        self.written = 0
+
+    def addUsers(self, users):
+        with self.lock, self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO users VALUES (?, ?, ?, ?)',
+                [(user['id'], user.get('name'), user.get('real_name'), jsonCodec.dumps(user))
+                 for user in users])
+
+    def addChannels(self, conversations, conversationType):
+        with self.lock, self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO channels VALUES (?, ?, ?, ?)',
+                [(conversation['id'], conversation.get('name'), conversationType,
+                  jsonCodec.dumps(conversation)) for conversation in conversations])
+
+    def add(self, channelId, messages):
+        with self.lock:
+            for message in messages:
+                self.messages.append((
+                    channelId, message['ts'], message.get('user'), message.get('thread_ts'),
+                    message.get('subtype'), message.get('text'), jsonCodec.dumps(message)))
+                for slackFile in message.get('files', []):
+                    if 'id' in slackFile:
+                        self.files.append((
+                            slackFile['id'], channelId, message['ts'], slackFile.get('name'),
+                            slackFile.get('mimetype'), slackFile.get('size'), slackFile.get('url_private')))
+            if len(self.messages) >= self.batchSize:
+                self.flush()
+
+    # passes the pages of a conversation through, adding their messages
+    def tee(self, channelId, pages):
+        for page in pages:
+            self.add(channelId, page)
+            yield page
+
+    # writes the buffered rows in one transaction; the caller holds the lock
+    def flush(self):
+        with self.connection:
+            self.connection.executemany(
+                'INSERT INTO messages VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (channel, ts) DO UPDATE SET '
+                'user = excluded.user, thread_ts = excluded.thread_ts, subtype = excluded.subtype, '
+                'text = excluded.text, json = excluded.json',
+                self.messages)
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)', self.files)
+        self.written += len(self.messages)
+        self.messages = []
+        self.files = []
+
+    def close(self):
+        with self.lock:
+            self.flush()
+            self.connection.close()
+
+
+# Writes messages to a Parquet dataset for analytics, next to the regular
+# output. Every conversation gets its own partition directory,
+# channel=<id>/, and every export run a file in it, written a row group at a
+# time while the history streams in. The core fields of each message get
+# their own column, and the raw message is kept as JSON in the json column:
+#
+#   pandas.read_parquet(DIRECTORY)  # with a 'channel' column from the directories
+class ParquetExport:
+    rowGroupSize = 50000
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.runName = 'part-{0:%Y%m%d-%H%M%S}.parquet'.format(datetime.now())
+        self.schema = pyarrow.schema([
+            ('ts', pyarrow.string()),
+            ('time', pyarrow.timestamp('us', tz='UTC')),
+            ('user', pyarrow.string()),
+            ('text', pyarrow.string()),
+            ('thread_ts', pyarrow.string()),
+            ('subtype', pyarrow.string()),
+            ('reply_count', pyarrow.int64()),
+            ('file_ids', pyarrow.list_(pyarrow.string())),
+            ('json', pyarrow.string()),
+        ])
+        self.lock = threading.Lock()
+        self.written = 0
+        mkdir(directory)
+
+    def rowGroup(self, messages):
+        columns = {name: [] for name in self.schema.names}
+        for message in messages:
+            columns['ts'].append(message['ts'])
+            seconds, _, fraction = message['ts'].partition('.')
+            columns['time'].append(int(seconds) * 1000000 + int(fraction[:6].ljust(6, '0')))
+            columns['user'].append(message.get('user'))
+            columns['text'].append(message.get('text'))
+            columns['thread_ts'].append(message.get('thread_ts'))
+            columns['subtype'].append(message.get('subtype'))
+            columns['reply_count'].append(message.get('reply_count'))
+            columns['file_ids'].append([slackFile['id'] for slackFile in message.get('files', [])
+                                        if 'id' in slackFile])
+            columns['json'].append(jsonCodec.dumps(message))
+        return pyarrow.Table.from_pydict(columns, schema=self.schema)
+
+    # passes the pages of a conversation through, writing their messages to
+    # the conversation's file; it is renamed into place once it is complete.
+    # Until then its name starts with '.', which dataset discovery skips, so
+    # an interrupted export doesn't leave a file that breaks reading the dataset
+    def tee(self, channelId, pages):
+        directory = os.path.join(self.directory, 'channel={0}'.format(channelId))
+        mkdir(directory)
+        fileName = os.path.join(directory, self.runName)
+        temporaryFile = os.path.join(directory, '.' + self.runName + '.tmp')
+        writer = None
+        pending = []
+        pendingRows = 0
+        rows = 0
+
+        def writeRowGroup():
+            nonlocal writer, pendingRows
+            if writer is None:
+                writer = pyarrow.parquet.ParquetWriter(temporaryFile, self.schema)
+            writer.write_table(pyarrow.concat_tables(pending))
+            pending.clear()
+            pendingRows = 0
+
+        try:
+            for page in pages:
+                # converted right away, before the day file writers point
+                # the file links at local copies
+                pending.append(self.rowGroup(page))
+                pendingRows += len(page)
+                rows += len(page)
+                if pendingRows >= self.rowGroupSize:
+                    writeRowGroup()
+                yield page
+            if pending:
+                writeRowGroup()
+        finally:
+            if writer is not None:
+                writer.close()
+        if writer is not None:
+            os.replace(temporaryFile, fileName)
+        with self.lock:
+            self.written += rows
+
+
+def dumpJson(data):
+    return jsonCodec.dumps(data, indent=4 if outputFormat == 'viewer' else None)
+
+
+def dumpJsonLine(message):
+    return jsonCodec.dumps(message) + '\n'
+
+
+# the file the messages of roomDir from fileDate are written to
+def messageFileName(roomDir, fileDate):
+    if outputFormat == 'jsonl-conversation':
+        return '{room}/messages.jsonl'.format(room=roomDir)
+    extension = '.jsonl' if outputFormat == 'jsonl' else '.json'
+    return '{room}/{file}{extension}'.format(room=roomDir, file=fileDate, extension=extension)
+
+
+def iterJsonLines(fileName):
+    with open(fileName, encoding='utf-8') as inFile:
+        for line in inFile:
+            if line.strip():
+                yield jsonCodec.loads(line)
+
+
+# reads a file of messages in any of the output formats
+def readMessageFile(fileName):
+    if fileName.endswith('.jsonl'):
+        return list(iterJsonLines(fileName))
+    with open(fileName, encoding='utf-8') as inFile:
+        return jsonCodec.loads(inFile.read())
+
+
+# writes data to fileName in the output format, on disk or in the archive;
+# lists of messages go to .jsonl files a message per line
+def writeJsonFile(fileName, data):
+    if fileName.endswith('.jsonl'):
+        text = ''.join(dumpJsonLine(message) for message in data)
+    else:
+        text = dumpJson(data)
+    if archive is not None:
+        archive.write(fileName, text)
+        return
+    with open(fileName, 'w', encoding='utf-8') as outFile:
+        outFile.write(text)
 
 
 def mkdir(directory):
@@ -113,72 +850,315 @@ def mkdir(directory):
         os.makedirs(directory)
 
 
-# create datetime object from slack timestamp ('ts') string
-def parseTimeStamp(timeStamp):
-    if '.' in timeStamp:
-        t_list = timeStamp.split('.')
-        if len(t_list) != 2:
-            raise ValueError('Invalid time stamp')
-        else:
-            return datetime.utcfromtimestamp(float(t_list[0]))
-
-
-# move channel files from old directory to one with new channel name
-def channelRename(oldRoomName, newRoomName):
-    # check if any files need to be moved
-    if not os.path.isdir(oldRoomName):
-        return
-    mkdir(newRoomName)
-    for fileName in os.listdir(oldRoomName):
-        shutil.move(os.path.join(oldRoomName, fileName), newRoomName)
-    os.rmdir(oldRoomName)
+# whole seconds of a slack timestamp ('ts') string
+def timeStampSeconds(timeStamp):
+    return int(timeStamp.partition('.')[0])
+
+
+# Assigns messages to days, in UTC or in timeZone. The bounds of the last day
+# seen are kept per thread, so most messages cost an integer comparison
+# rather than building and formatting a datetime; one is only built when a
+# message falls outside that day.
+class DayBuckets:
+    def __init__(self, timeZone=None):
+        self.timeZone = timeZone or timezone.utc
+        self.local = threading.local()
+
+    # (start, end, 'YYYY-MM-DD') of the day holding the epoch seconds given
+    def bucket(self, seconds):
+        start = datetime.fromtimestamp(seconds, self.timeZone).replace(
+            hour=0, minute=0, second=0, microsecond=0)
+        # adding a day to an aware datetime keeps the wall clock time, so the
+        # next midnight is found across daylight saving changes too
+        end = start + timedelta(days=1)
+        return int(start.timestamp()), int(end.timestamp()), '{:%Y-%m-%d}'.format(start)
+
+    def day(self, timeStamp):
+        seconds = timeStampSeconds(timeStamp)
+        current = getattr(self.local, 'current', None)
+        if current is None or not current[0] <= seconds < current[1]:
+            current = self.local.current = self.bucket(seconds)
+        return current[2]
+
+    # splits a list of messages sorted by 'ts' into (day, messages) pairs,
+    # finding where each day ends by binary search
+    def split(self, messages):
+        start = 0
+        while start < len(messages):
+            _, end, day = self.bucket(timeStampSeconds(messages[start]['ts']))
+            stop = bisect.bisect_left(messages, end, lo=start,
+                                      key=lambda message: timeStampSeconds(message['ts']))
+            yield day, messages[start:stop]
+            start = stop
+
+
+# day files are for days in UTC unless --timezone says otherwise
+dayBuckets = DayBuckets()
+
+
+# merges messages into those already in a day file, the new copy of a
+# message (same 'ts') replacing the old one
+def mergeMessageFile(fileName, messages):
+    if os.path.exists(fileName):
+        existing = readMessageFile(fileName)
+        byTimeStamp = {message['ts']: message for message in existing}
+        byTimeStamp.update((message['ts'], message) for message in messages)
+        messages = sorted(byTimeStamp.values(), key=messageTimeStamp)
+    return messages
 
 
-def writeMessageFile(fileName, messages):
+def writeMessageFile(fileName, messages, merge=False):
     directory = os.path.dirname(fileName)
 
     # if there's no data to write to the file, return
     if not messages:
         return
 
-    if not os.path.isdir(directory):
+    if archive is None and not os.path.isdir(directory):
         mkdir(directory)
 
-    with open(fileName, 'w') as outFile:
-        json.dump(messages, outFile, indent=4)
+    if merge:
+        messages = mergeMessageFile(fileName, messages)
+
+    # attachments are queued for download, and their links pointed at the
+    # local copies, before the file is written; merged messages of an
+    # earlier export may still link to files.slack.com too
+    localizeSlackFiles(messages, fileDownloader, fileName)
+
+    writeJsonFile(fileName, messages)
+
+
+# Time spent in each stage of the export, summed over all threads: fetching
+# history from Slack, writing day files and checkpoints, and fetching held up
+# by writes. Time a thread is blocked while it fetches a page (saving the
+# checkpoint of the page) counts as blocked, not as fetching.
+class StageTimes:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.seconds = {'fetch': 0.0, 'write': 0.0, 'blocked': 0.0}
+        self.local = threading.local()
+
+    def add(self, stage, seconds):
+        with self.lock:
+            self.seconds[stage] += seconds
+        if stage == 'blocked' and getattr(self.local, 'blocked', None) is not None:
+            self.local.blocked += seconds
+
+    def timed(self, stage, pages):
+        pages = iter(pages)
+        while True:
+            started = time.monotonic()
+            self.local.blocked = 0.0
+            try:
+                page = next(pages, None)
+            finally:
+                blocked, self.local.blocked = self.local.blocked, None
+            self.add(stage, time.monotonic() - started - blocked)
+            if page is None:
+                return
+            yield page
+
+    def report(self):
+        with self.lock:
+            return dict(self.seconds)
+
+
+stageTimes = StageTimes()
+
+
+# Writes day files and checkpoints on background threads, so that a slow disk
+# doesn't hold up fetching. Every file name maps to one of the threads, which
+# keeps the writes to a file in order (late thread replies are merged into the
+# day file written before them). The queue of each thread is bounded, so
+# fetching waits once the writers fall behind. A failed write is raised from
+# its future, and from every later submit so the export stops.
+class WriterPool:
+    queueSize = 16
+
+    def __init__(self, workers):
+        self.lock = threading.Lock()
+        self.error = None
+        self.queues = [queue.Queue(self.queueSize) for _ in range(workers)]
+        self.threads = [threading.Thread(target=self.run, args=(tasks,), daemon=True)
+                        for tasks in self.queues]
+        for thread in self.threads:
+            thread.start()
+
+    def run(self, tasks):
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+            future, function, args = task
+            if not future.set_running_or_notify_cancel():
+                continue
+            started = time.monotonic()
+            try:
+                future.set_result(function(*args))
+            except BaseException as e:
+                with self.lock:
+                    if self.error is None:
+                        self.error = e
+                future.set_exception(e)
+            finally:
+                stageTimes.add('write', time.monotonic() - started)
+
+    def submit(self, key, function, *args):
+        if self.error is not None:
+            raise self.error
+        future = Future()
+        started = time.monotonic()
+        self.queues[hash(key) % len(self.queues)].put((future, function, args))
+        stageTimes.add('blocked', time.monotonic() - started)
+        return future
+
+    def close(self):
+        for tasks in self.queues:
+            tasks.put(None)
+        for thread in self.threads:
+            thread.join()
+
+
+# runs function on the writer thread for key, or right away without writer
+# threads; returns what waitForWrites needs to wait for it
+def submitTask(key, function, *args):
+    if writerPool is not None:
+        return writerPool.submit(key, function, *args)
+    started = time.monotonic()
+    function(*args)
+    elapsed = time.monotonic() - started
+    stageTimes.add('write', elapsed)
+    stageTimes.add('blocked', elapsed)
+    return None
+
+
+def submitWrite(fileName, messages, merge):
+    return submitTask(fileName, writeMessageFile, fileName, messages, merge)
+
+
+# waits until the writes are done, re-raising the first failure
+def waitForWrites(writes):
+    started = time.monotonic()
+    for write in writes:
+        if write is not None:
+            write.result()
+    stageTimes.add('blocked', time.monotonic() - started)
+
+
+def messageFileDate(message):
+    return dayBuckets.day(message['ts'])
+
+
+# merges two streams of messages sorted by 'ts', the message from new
+# replacing the one from old with the same 'ts'
+def mergeSortedMessages(old, new):
+    tagged = heapq.merge(((message['ts'], 0, message) for message in old),
+                         ((message['ts'], 1, message) for message in new),
+                         key=lambda entry: entry[:2])
+    for timeStamp, entries in itertools.groupby(tagged, key=lambda entry: entry[0]):
+        *_, (_, _, message) = entries
+        yield message
+
+
+# writes the messages of a conversation, sorted by 'ts', to its single JSON
+# Lines file, a day at a time; with merge set, they are merged into the file
+# of a previous export.
+def writeConversationFile(roomDir, messages, merge=False):
+    fileName = messageFileName(roomDir, None)
+
+    merged = messages
+    if merge and os.path.exists(fileName):
+        merged = mergeSortedMessages(iterJsonLines(fileName), merged)
+
+    # the merged stream is localized, lines of an earlier export included
+    def localized():
+        for fileDate, dayMessages in itertools.groupby(merged, key=messageFileDate):
+            dayMessages = list(dayMessages)
+            localizeSlackFiles(dayMessages, fileDownloader, fileName)
+            yield from dayMessages
+
+    if archive is not None:
+        text = ''.join(dumpJsonLine(message) for message in localized())
+        if text:
+            archive.write(fileName, text)
+        return
+
+    mkdir(roomDir)
+    written = 0
+    with open(fileName + '.tmp', 'w', encoding='utf-8') as outFile:
+        for message in localized():
+            outFile.write(dumpJsonLine(message))
+            written += 1
+    if written:
+        os.replace(fileName + '.tmp', fileName)
+    else:
+        os.remove(fileName + '.tmp')
+
+
+# parse messages by date, writing one file per day
+#
+# pages come from iterHistory: each one is sorted by 'ts', and each page holds
+# older top-level messages than the one before. Once a page has been read, no
+# later page can add top-level messages to a day newer than the page's first
+# message, so those days are written out and dropped from memory. Thread
+# replies to older messages can still turn up later for such a day; they are
+# kept in memory until the conversation is complete, and then merged into
+# their day files in one pass, so no day file is rewritten more than once.
+#
+# With merge set, new messages are also merged into day files from a previous
+# export.
+def parseMessages(roomDir, pages, merge=False):
+    pendingDays = {}
+    lateReplies = {}
+    writtenDays = set()
+    writes = []
+
+    def writeDay(fileDate):
+        outFileName = messageFileName(roomDir, fileDate)
+        writes.append(submitWrite(outFileName, pendingDays.pop(fileDate), merge))
+        writtenDays.add(fileDate)
+
+    for page in pages:
+        if not page:
+            continue
+
+        for fileDate, dayMessages in dayBuckets.split(page):
+            days = lateReplies if fileDate in writtenDays else pendingDays
+            if fileDate in days:
+                days[fileDate] = list(heapq.merge(
+                    days[fileDate], dayMessages, key=messageTimeStamp))
+            else:
+                days[fileDate] = dayMessages
+
+        oldestDate = messageFileDate(page[0])
+        for fileDate in [date for date in pendingDays if date > oldestDate]:
+            writeDay(fileDate)
 
+    for fileDate in sorted(pendingDays):
+        writeDay(fileDate)
 
-# parse messages by date
-def parseMessages(roomDir, messages, roomType):
-    nameChangeFlag = roomType + "_name"
+    # the writes of a file stay in order, so these merge into the day files
+    # written above
+    for fileDate in sorted(lateReplies):
+        outFileName = messageFileName(roomDir, fileDate)
+        writes.append(submitWrite(outFileName, lateReplies[fileDate], True))
 
-    currentFileDate = ''
-    currentMessages = []
-    for message in messages:
-        # first store the date of the next message
-        ts = parseTimeStamp(message['ts'])
-        fileDate = '{:%Y-%m-%d}'.format(ts)
+    waitForWrites(writes)
 
-        # if it's on a different day, write out the previous day's messages
-        if fileDate != currentFileDate:
-            outFileName = '{room}/{file}.json'.format(
-                room=roomDir, file=currentFileDate)
-            writeMessageFile(outFileName, currentMessages)
-            currentFileDate = fileDate
-            currentMessages = []
 
-        # check if current message is a name change
-        # dms won't have name change events
-        if roomType != "im" and ('subtype' in message) and message['subtype'] == nameChangeFlag:
-            roomDir = message['name']
-            oldRoomPath = message['old_name']
-            newRoomPath = roomDir
-            channelRename(oldRoomPath, newRoomPath)
+# parse messages sorted by 'ts' by date, writing each day file exactly once
+def parseSortedMessages(roomDir, messages, merge=False):
+    if outputFormat == 'jsonl-conversation':
+        writeConversationFile(roomDir, messages, merge)
+        return
+
+    writes = []
+    for fileDate, dayMessages in itertools.groupby(messages, key=messageFileDate):
+        dayMessages = list(dayMessages)
+        outFileName = messageFileName(roomDir, fileDate)
+        writes.append(submitWrite(outFileName, dayMessages, merge))
 
-        currentMessages.append(message)
-    outFileName = '{room}/{file}.json'.format(
-        room=roomDir, file=currentFileDate)
-    writeMessageFile(outFileName, currentMessages)
+    waitForWrites(writes)
 
 
 def filterConversationsByName(channelsOrGroups, channelOrGroupNames):
@@ -191,7 +1171,143 @@ def promptForPublicChannels(channels):
         channelNames, 'Select the Public Channels you want to export:', multiselect=True)  # type: ignore
     return [channels[index] for channelName, index in selectedChannels]
 
-# fetch and write history for all public channels
+# a conversation whose history is waiting to be fetched and written to roomDir
+class ExportJob(NamedTuple):
+    description: str
+    roomDir: str
+    conversation: Mapping[str, Any]
+
+
+def exportConversation(job):
+    conversationId = job.conversation['id']
+    if checkpoint.isDone(conversationId):
+        print("Skipping {0}, already exported".format(job.description))
+        return
+
+    oldest = highWaterMarks.get(conversationId) if incremental else None
+    if oldest:
+        print("Fetching history newer than {0} for {1}".format(oldest, job.description))
+    else:
+        print("Fetching history for {0}".format(job.description))
+    newest = []
+
+    def trackNewest(pages):
+        for page in pages:
+            newest.append(newestTopLevelTimeStamp(page))
+            yield page
+
+    pages = trackNewest(stageTimes.timed(
+        'fetch', iterHistory(conversationId, checkpoint=checkpoint, oldest=oldest)))
+    if sqliteExport is not None:
+        pages = sqliteExport.tee(conversationId, pages)
+    if parquetExport is not None:
+        pages = parquetExport.tee(conversationId, pages)
+    # job.roomDir is named after the conversation's current name, which the
+    # rename events in its history lead up to, so every file is written to
+    # its final directory right away; an --incremental export has already
+    # moved the directory of a previous run there
+    sortFirst = archive is not None or outputFormat == 'jsonl-conversation'
+    if not sortFirst and spillMessages is None and spillBytes is None:
+        parseMessages(job.roomDir, pages, merge=incremental)
+    else:
+        sorter = ExternalSorter(
+            spillMessages if spillMessages or spillBytes else sortSpillMessages,
+            spillBytes, spillDirectory)
+        for page in pages:
+            sorter.add(page)
+        parseSortedMessages(job.roomDir, sorter.sortedMessages(), merge=incremental)
+    newestTimeStamp = max(filter(None, newest), key=float, default=None)
+    highWaterMarks.update(conversationId, newestTimeStamp, job.roomDir)
+    stateSaver.finish(conversationId)
+
+
+# The attachment manifest and the high-water marks are rewritten whole when
+# they are saved, so they are saved every interval seconds rather than after
+# every conversation. A conversation is only marked done in the checkpoint
+# once a save covers it; a resumed export replays the conversations finished
+# since the last save from their spool files.
+class StateSaver:
+    def __init__(self, interval=30):
+        self.lock = threading.Lock()
+        self.interval = interval
+        self.lastSave = time.monotonic()
+        self.finished = []
+
+    def finish(self, conversationId):
+        with self.lock:
+            self.finished.append(conversationId)
+            if time.monotonic() - self.lastSave >= self.interval:
+                self.saveLocked()
+
+    def save(self):
+        with self.lock:
+            self.saveLocked()
+
+    def saveLocked(self):
+        attachmentManifest.save()
+        highWaterMarks.save()
+        for conversationId in self.finished:
+            checkpoint.markDone(conversationId)
+        self.finished = []
+        self.lastSave = time.monotonic()
+
+
+stateSaver = StateSaver()
+
+
+# fetch and write history for all jobs, exportWorkers conversations at a time.
+# Every conversation is written to its own directory, so the output is the same
+# as exporting them one after another.
+def exportConversations(jobs):
+    global writerPool, replyPool
+    if writerThreads > 0:
+        writerPool = WriterPool(writerThreads)
+    replyPool = ThreadPoolExecutor(max_workers=max(1, threadWorkers))
+    try:
+        if exportWorkers <= 1 or len(jobs) <= 1:
+            for job in jobs:
+                exportConversation(job)
+        else:
+            executor = ThreadPoolExecutor(max_workers=min(exportWorkers, len(jobs)))
+            try:
+                futures = [executor.submit(exportConversation, job) for job in jobs]
+                # re-raise the first failure (in job order) on the main thread
+                for future in futures:
+                    future.result()
+            finally:
+                # after a failure, the jobs that haven't started are dropped
+                # rather than run before the error is shown
+                executor.shutdown(cancel_futures=True)
+        # while the writer threads are still there to finish the checkpoints
+        stateSaver.save()
+    finally:
+        replyPool.shutdown()
+        replyPool = None
+        if writerPool is not None:
+            writerPool.close()
+            writerPool = None
+
+# An --incremental export into a directory where a conversation was exported
+# under another name: its directory is moved to the current name with a
+# single rename before anything is written, so its earlier days stay with
+# the new ones and channels.json keeps pointing at all of them
+def moveRenamedConversation(conversation, roomDir):
+    previousDir = highWaterMarks.directory(conversation['id'])
+    if not incremental or previousDir in (None, roomDir) or not os.path.isdir(previousDir):
+        return
+    if os.path.isdir(roomDir):
+        if os.listdir(roomDir):
+            print("Not moving {0} to {1} after a rename, {1} is in use".format(previousDir, roomDir))
+            return
+        os.rmdir(roomDir)
+    print("Moving {0} to {1} after a rename".format(previousDir, roomDir))
+    os.rename(previousDir, roomDir)
+    attachmentManifest.moveDirectory(previousDir, roomDir)
+    attachmentManifest.save()
+    highWaterMarks.update(conversation['id'], directory=roomDir)
+    highWaterMarks.save()
+
+# list the export jobs for all public channels
 
 
 def fetchPublicChannels(channels):
@@ -201,21 +1317,24 @@ def fetchPublicChannels(channels):
         for channel in channels:
             print(channel['name'])
         print()
-        return
+        return []
 
+    jobs = []
     for channel in channels:
         channelDir = channel['name']
-        print("Fetching history for Public Channel: {0}".format(channelDir))
         try:
+            moveRenamedConversation(channel, channelDir)
             mkdir(channelDir)
         except NotADirectoryError:
             # Failed creating directory, probably because the name is not a valid
             # Windows directory name (like "com4"). Adding a prefix to try to work-around
             # that.
             channelDir = ("c-" + channel['name'])
+            moveRenamedConversation(channel, channelDir)
             mkdir(channelDir)
-        messages = getHistory(channel['id'])
-        parseMessages(channelDir, messages, 'channel')
+        jobs.append(ExportJob("Public Channel: {0}".format(channelDir),
+                              channelDir, channel))
+    return jobs
 
 # write channels.json file
 
@@ -237,14 +1356,10 @@ def dumpChannelFile():
         dm['members'] = [dm['user'], tokenOwnerId]
 
     # We will be overwriting this file on each run.
-    with open('channels.json', 'w') as outFile:
-        json.dump(channels, outFile, indent=4)
-    with open('groups.json', 'w') as outFile:
-        json.dump(private, outFile, indent=4)
-    with open('mpims.json', 'w') as outFile:
-        json.dump(mpim, outFile, indent=4)
-    with open('dms.json', 'w') as outFile:
-        json.dump(dms, outFile, indent=4)
+    writeJsonFile('channels.json', channels)
+    writeJsonFile('groups.json', private)
+    writeJsonFile('mpims.json', mpim)
+    writeJsonFile('dms.json', dms)
 
 
 def filterDirectMessagesByUserNameOrId(dms, userNamesOrIds):
@@ -260,7 +1375,7 @@ def promptForDirectMessages(dms):
         dmNames, 'Select the 1:1 DMs you want to export:', multiselect=True)  # type: ignore
     return [dms[index] for dmName, index in selectedDms]
 
-# fetch and write history for all direct message conversations
+# list the export jobs for all direct message conversations
 # also known as IMs in the slack API.
 
 
@@ -272,15 +1387,15 @@ def fetchDirectMessages(dms):
             print(userNamesById.get(dm['user'],
                   dm['user'] + " (name unknown)"))
         print()
-        return
+        return []
 
+    jobs = []
     for dm in dms:
         name = userNamesById.get(dm['user'], dm['user'] + " (name unknown)")
-        print("Fetching 1:1 DMs with {0}".format(name))
         dmId = dm['id']
         mkdir(dmId)
-        messages = getHistory(dm['id'])
-        parseMessages(dmId, messages, "im")
+        jobs.append(ExportJob("1:1 DMs with {0}".format(name), dmId, dm))
+    return jobs
 
 
 def promptForGroups(groups):
@@ -289,7 +1404,7 @@ def promptForGroups(groups):
         groupNames, 'Select the Private Channels and Group DMs you want to export:', multiselect=True)  # type: ignore
     return [groups[index] for groupName, index in selectedGroups]
 
-# fetch and write history for specific private channel
+# list the export jobs for specific private channels
 # also known as groups in the slack API.
 
 
@@ -300,16 +1415,17 @@ def fetchGroups(groups):
         for group in groups:
             print(group['name'])
         print()
-        return
+        return []
 
+    jobs = []
     for group in groups:
         groupDir = group['name']
+        moveRenamedConversation(group, groupDir)
         mkdir(groupDir)
-        messages = []
-        print(
-            "Fetching history for Private Channel / Group DM: {0}".format(group['name']))
-        messages = getHistory(group['id'])
-        parseMessages(groupDir, messages, 'group')
+        jobs.append(ExportJob(
+            "Private Channel / Group DM: {0}".format(group['name']),
+            groupDir, group))
+    return jobs
 
 # fetch all users for the channel and return a map userId -> userName
 
@@ -325,8 +1441,7 @@ def getUserMap():
 
 def dumpUserFile():
     # write to user file, any existing file needs to be overwritten.
-    with open("users.json", 'w') as userFile:
-        json.dump(users, userFile, indent=4)
+    writeJsonFile("users.json", users)
 
 # get basic info about the slack channel to ensure the authentication token works
 
@@ -363,7 +1478,6 @@ def getAllChannels(types, exclude_archived=False, get_members=True):
             for channel in items:
                 channel["members"] = getChannelMembers(channel)
                 print("Retrieved members of {0}".format(channel['name']))
-        # sleep(3.05)
 
     return paginatedRequest(getResponse, 'channels', processItemPage)
 
@@ -373,7 +1487,6 @@ def bootstrapKeyValues(args):
 
     users = slack.users.list().body['members']
     print("Found {0} Users".format(len(users)))
-    sleep(3.05)
 
     if (args.publicChannels is None):
       print("Not fetching public channels")
@@ -435,79 +1548,646 @@ def dumpDummyChannel():
     writeMessageFile(outFileName, [])
 
 
-def downloadFiles(token, cookie_header={}):
+# Sidecar index of the Slack files referenced by the export, so that download
+# and retry passes only open the day files that need it.
+#
+# For every Slack file ID it records the day files that reference the file and,
+# for every URL key (url_private, thumb_64, ...), the original URL, the local
+# copy and its download state (None until queued, then pending, done or
+# failed). It also lists the day files that still link to files.slack.com
+# because they were written without --downloadSlackFiles.
+class AttachmentManifest:
+    fileName = '.files-manifest.json'
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.files = {}
+        self.remote = set()
+        if os.path.exists(self.fileName):
+            with open(self.fileName, encoding='utf-8') as inFile:
+                manifest = jsonCodec.loads(inFile.read())
+            self.files = manifest['files']
+            self.remote = set(manifest['remoteDayFiles'])
+
+        self.byLocalFile = {}
+        for fileId, entry in self.files.items():
+            for key, link in entry['urls'].items():
+                self.byLocalFile.setdefault(link['localFile'], []).append(link)
+
+    def record(self, fileId, key, url, localFile, dayFile, queued, size=None):
+        with self.lock:
+            entry = self.files.setdefault(fileId, {'dayFiles': [], 'urls': {}})
+            if dayFile not in entry['dayFiles']:
+                entry['dayFiles'].append(dayFile)
+
+            link = entry['urls'].get(key)
+            if link is None:
+                link = entry['urls'][key] = {'url': url, 'localFile': localFile, 'state': None,
+                                             'blobKey': blobKey(fileId, key)}
+                self.byLocalFile.setdefault(localFile, []).append(link)
+            if size is not None:
+                link['size'] = size
+
+            if not queued:
+                self.remote.add(dayFile)
+            elif link['state'] is None:
+                link['state'] = 'pending'
+
+    # day files moved to another directory by a rename
+    def moveDirectory(self, oldDirectory, newDirectory):
+        def moved(dayFile):
+            if dayFile.startswith(oldDirectory + '/'):
+                return newDirectory + dayFile[len(oldDirectory):]
+            return dayFile
+
+        with self.lock:
+            for entry in self.files.values():
+                entry['dayFiles'] = [moved(dayFile) for dayFile in entry['dayFiles']]
+            self.remote = {moved(dayFile) for dayFile in self.remote}
+
+    # a day file was (re)written with all of its links pointing at local copies
+    def localized(self, dayFile):
+        with self.lock:
+            self.remote.discard(dayFile)
+
+    def setState(self, localFile, state):
+        with self.lock:
+            for link in self.byLocalFile.get(localFile, []):
+                link['state'] = state
+
+    def blobKey(self, localFile):
+        with self.lock:
+            for link in self.byLocalFile.get(localFile, []):
+                if link.get('blobKey'):
+                    return link['blobKey']
+        return None
+
+    def etag(self, localFile):
+        with self.lock:
+            for link in self.byLocalFile.get(localFile, []):
+                if 'etag' in link:
+                    return link['etag']
+        return None
+
+    def setEtag(self, localFile, etag):
+        with self.lock:
+            for link in self.byLocalFile.get(localFile, []):
+                link['etag'] = etag
+
+    # (url, localFile, expected size) of every download that is done
+    def downloadedFiles(self):
+        with self.lock:
+            return [(link['url'], link['localFile'], link.get('size'))
+                    for entry in self.files.values() for link in entry['urls'].values()
+                    if link['state'] == 'done']
+
+    # day files with links that still point at files.slack.com
+    def remoteDayFiles(self):
+        with self.lock:
+            return sorted(self.remote)
+
+    # (url, localFile, expected size) of the downloads that were queued or
+    # failed but never finished
+    def incompleteDownloads(self):
+        with self.lock:
+            return [(link['url'], link['localFile'], link.get('size'))
+                    for entry in self.files.values() for link in entry['urls'].values()
+                    if link['state'] in ('pending', 'failed')]
+
+    def save(self):
+        with self.lock:
+            with open(self.fileName + '.tmp', 'w', encoding='utf-8') as outFile:
+                outFile.write(jsonCodec.dumps({'files': self.files, 'remoteDayFiles': sorted(self.remote)}))
+            os.replace(self.fileName + '.tmp', self.fileName)
+
+
+# url_private_download is the same content as url_private, served as an attachment
+def blobKey(fileId, key):
+    return "%s/%s" % (fileId, "url_private" if key == "url_private_download" else key)
+
+
+# Content-addressed store of downloaded files, shared by any number of
+# exports. Blobs are named by the SHA-256 of their content, and an index maps
+# each Slack file ID and variant (original or thumb_*) to its blob, so a file
+# is only downloaded once for all exports and identical content is only kept
+# once. Exports get hardlinks to the blobs, or symlinks where hardlinks are
+# not possible (the store is on another file system) or not wanted.
+class BlobStore:
+    indexName = 'index.json'
+
+    def __init__(self, directory, symlinks=False):
+        self.directory = directory
+        self.symlinks = symlinks
+        self.lock = threading.Lock()
+        self.index = {}
+        self.linked = 0
+        self.linkedBytes = 0
+        mkdir(os.path.join(directory, 'objects'))
+        indexFile = os.path.join(directory, self.indexName)
+        if os.path.exists(indexFile):
+            with open(indexFile) as inFile:
+                self.index = json.load(inFile)
+
+    def blobPath(self, digest):
+        return os.path.join(self.directory, 'objects', digest[:2], digest)
+
+    # the blob stored for key, if it is there and has the expected size
+    def lookup(self, key, expectedSize):
+        if key is None:
+            return None
+        with self.lock:
+            digest = self.index.get(key)
+        if digest is None:
+            return None
+        blob = self.blobPath(digest)
+        return blob if isDownloaded(blob, expectedSize) else None
+
+    # moves a downloaded file into the store, dropping it if the same content
+    # is already there, and returns its blob
+    def add(self, key, fileName):
+        digest = hashlib.sha256()
+        with open(fileName, 'rb') as inFile:
+            for chunk in iter(lambda: inFile.read(1024 * 1024), b''):
+                digest.update(chunk)
+        digest = digest.hexdigest()
+
+        blob = self.blobPath(digest)
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        if os.path.exists(blob):
+            os.remove(fileName)
+        else:
+            shutil.move(fileName, blob)
+        if key is not None:
+            with self.lock:
+                self.index[key] = digest
+        return blob
+
+    def link(self, blob, localFile):
+        os.makedirs(os.path.dirname(localFile), exist_ok=True)
+        if os.path.lexists(localFile):
+            os.remove(localFile)
+        if not self.symlinks:
+            try:
+                os.link(blob, localFile)
+                return
+            except OSError:
+                pass
+        os.symlink(os.path.abspath(blob), localFile)
+
+    def save(self):
+        indexFile = os.path.join(self.directory, self.indexName)
+        with self.lock:
+            # keep what other exports sharing the store added in the meantime
+            index = {}
+            if os.path.exists(indexFile):
+                with open(indexFile) as inFile:
+                    index = json.load(inFile)
+            index.update(self.index)
+            self.index = index
+            temporaryFile = "%s.%d.tmp" % (indexFile, os.getpid())
+            with open(temporaryFile, 'w') as outFile:
+                json.dump(index, outFile)
+            os.replace(temporaryFile, indexFile)
+
+
+def isDownloaded(localFile, expectedSize):
+    if not os.path.exists(localFile):
+        return False
+    size = os.path.getsize(localFile)
+    return size == expectedSize if expectedSize is not None else size > 0
+
+
+# Downloads files on a pool of worker threads. Each file is streamed to disk
+# chunk by chunk into a temporary file that is renamed into place once it is
+# complete, so a partial download never looks like a finished one. A shared
+# token bucket can cap the total bandwidth used by all workers.
+class FileDownloader:
+    chunkSize = 1024 * 1024
+
+    def __init__(self, session, headers, retryPolicy, timeout, workers=8, bytesPerSecond=None,
+                 manifest=None, blobStore=None):
+        self.session = session
+        self.manifest = manifest
+        self.blobStore = blobStore
+        self.headers = headers
+        self.retryPolicy = retryPolicy
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        # bounds the number of queued downloads, so queueing blocks when workers fall behind
+        self.slots = threading.BoundedSemaphore(workers * 4)
+        self.bandwidth = None
+        if bytesPerSecond:
+            self.bandwidth = TokenBucket(bytesPerSecond * 60, max(self.chunkSize, int(bytesPerSecond)))
+        self.lock = threading.Lock()
+        self.queued = set()
+        # one lock per blob key, so variants sharing a blob are downloaded once
+        self.blobLocks = {}
+        self.futures = []
+        self.downloaded = 0
+        self.downloadedBytes = 0
+        self.failed = 0
+
+    def submit(self, url, localFile, expectedSize=None):
+        with self.lock:
+            if localFile in self.queued:
+                return
+            self.queued.add(localFile)
+
+        self.slots.acquire()
+        future = self.executor.submit(self.download, url, localFile, expectedSize)
+        future.add_done_callback(lambda future: self.slots.release())
+        self.futures.append(future)
+
+    def download(self, url, localFile, expectedSize=None):
+        try:
+            if self.blobStore is None:
+                self.fetch(url, localFile, expectedSize)
+                return
+
+            key = self.manifest.blobKey(localFile) if self.manifest is not None else None
+            with self.lock:
+                blobLock = self.blobLocks.setdefault(key, threading.Lock())
+            with blobLock:
+                blob = self.blobStore.lookup(key, expectedSize)
+                if blob is not None:
+                    self.blobStore.link(blob, localFile)
+                    self.setState(localFile, 'done')
+                    with self.lock:
+                        self.blobStore.linked += 1
+                        self.blobStore.linkedBytes += os.path.getsize(blob)
+                    return
+                self.fetch(url, localFile, expectedSize, key)
+        finally:
+            with self.lock:
+                self.queued.discard(localFile)
+
+    def fetch(self, url, localFile, expectedSize, blobKey=None):
+        # Check if file already downloaded, with the size Slack reported for it
+        # (thumbnails don't have a size, for those any non-zero size will do)
+        if isDownloaded(localFile, expectedSize):
+            print("Skipping already downloaded file: %s" % localFile)
+            self.setState(localFile, 'done')
+            return
+
+        print("Downloading %s, saving to %s" % (url, localFile))
+        os.makedirs(os.path.dirname(localFile), exist_ok=True)
+        temporaryFile = localFile + '.part'
+        written = [0]
+
+        def attempt(timeout):
+            # carry on from what an earlier attempt (or run) left in the
+            # temporary file; If-Range makes the server send the whole file
+            # again if it changed in the meantime
+            headers = dict(self.headers)
+            offset = os.path.getsize(temporaryFile) if os.path.exists(temporaryFile) else 0
+            etag = self.manifest.etag(localFile) if self.manifest is not None else None
+            if offset:
+                headers['Range'] = 'bytes=%d-' % offset
+                if etag:
+                    headers['If-Range'] = etag
+
+            response = self.session.get(url, headers=headers, timeout=timeout, stream=True)
+            with response:
+                if response.status_code == requests.codes.requested_range_not_satisfiable:
+                    # nothing left to fetch if the temporary file is already complete
+                    if offset and offset == expectedSize:
+                        response.status_code = requests.codes.partial_content
+                        return response
+                    # otherwise, e.g. for a thumbnail that has no size to
+                    # compare with, the temporary file can't be trusted;
+                    # the whole file is fetched again
+                    if offset:
+                        os.remove(temporaryFile)
+                        return attempt(timeout)
+                    return response
+                if response.status_code not in (requests.codes.ok, requests.codes.partial_content):
+                    return response
+
+                if self.manifest is not None and response.headers.get('ETag'):
+                    self.manifest.setEtag(localFile, response.headers['ETag'])
+                mode = 'ab' if response.status_code == requests.codes.partial_content else 'wb'
+                with open(temporaryFile, mode) as outFile:
+                    for chunk in response.iter_content(self.chunkSize):
+                        if self.bandwidth is not None:
+                            self.bandwidth.acquire(len(chunk))
+                        outFile.write(chunk)
+                        written[0] += len(chunk)
+            return response
+
+        try:
+            response = self.retryPolicy.call(attempt, self.timeout, url)
+        except (requests.exceptions.RequestException, OSError) as e:
+            response = None
+            error = str(e)
+        else:
+            error = "HTTP %d" % response.status_code
+
+        if response is not None and response.status_code in (requests.codes.ok,
+                                                             requests.codes.partial_content):
+            size = os.path.getsize(temporaryFile)
+            if expectedSize is None or size == expectedSize:
+                if self.blobStore is not None:
+                    self.blobStore.link(self.blobStore.add(blobKey, temporaryFile), localFile)
+                else:
+                    os.replace(temporaryFile, localFile)
+                self.setState(localFile, 'done')
+                with self.lock:
+                    self.downloaded += 1
+                    self.downloadedBytes += written[0]
+                return
+            # a corrupt temporary file would only be resumed into a corrupt file
+            error = "got %d bytes, expected %d" % (size, expectedSize)
+            os.remove(temporaryFile)
+
+        # the temporary file is kept, the next attempt resumes from it
+        print("Failed to download %s: %s" % (url, error))
+        with self.lock:
+            self.failed += 1
+        self.setState(localFile, 'failed')
+
+    def setState(self, localFile, state):
+        if self.manifest is not None:
+            self.manifest.setState(localFile, state)
+
+    # waits for all queued downloads to finish
+    def wait(self):
+        while self.futures:
+            self.futures.pop(0).result()
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
+        print("Downloaded {0} files ({1:.1f} MB), {2} failed".format(
+            self.downloaded, self.downloadedBytes / (1024 * 1024), self.failed))
+        if self.blobStore is not None:
+            self.blobStore.save()
+            print("Linked {0} files ({1:.1f} MB) from the blob store".format(
+                self.blobStore.linked, self.blobStore.linkedBytes / (1024 * 1024)))
+
+
+# Decides which of the files.slack.com URLs of a file object are downloaded
+# before any of them is queued, and keeps count of what it leaves out. Slack
+# lists up to a dozen thumbnails for every image, so downloading only the
+# variants that are needed saves most of the requests. URLs that are not
+# downloaded keep pointing at files.slack.com.
+class FilePolicy:
+    variants = ('all', 'original', 'largest-thumbnail', 'original+largest-thumbnail')
+
+    def __init__(self, variants='all', maxBytes=None, allowTypes=(), denyTypes=()):
+        self.variants = variants
+        self.maxBytes = maxBytes
+        self.allowTypes = allowTypes
+        self.denyTypes = denyTypes
+        self.lock = threading.Lock()
+        self.seen = set()
+        self.planned = 0
+        self.plannedBytes = 0
+        self.skipped = 0
+        self.skippedBytes = 0
+
+    def typeAllowed(self, mimeType):
+        mimeType = (mimeType or '').lower()
+        if any(fnmatch.fnmatch(mimeType, pattern) for pattern in self.denyTypes):
+            return False
+        return not self.allowTypes or any(fnmatch.fnmatch(mimeType, pattern) for pattern in self.allowTypes)
+
+    # the keys of the URLs of slackFile that are downloaded
+    def select(self, slackFile):
+        keys = [key for key, value in slackFile.items()
+                if isinstance(value, str) and value.startswith("https://files.slack.com/")]
+        originals = [key for key in ("url_private", "url_private_download") if key in keys]
+        thumbnails = [key for key in keys if key.startswith("thumb_")]
+
+        if not self.typeAllowed(slackFile.get("mimetype")):
+            selected = set()
+        elif self.variants == 'all':
+            selected = set(keys)
+        else:
+            selected = set()
+            if self.variants in ('original', 'original+largest-thumbnail') and originals:
+                # url_private_download is the same file as url_private
+                selected.add(originals[0])
+            if self.variants in ('largest-thumbnail', 'original+largest-thumbnail') and thumbnails:
+                sized = [key for key in thumbnails if key[len("thumb_"):].isdigit()]
+                selected.add(max(sized, key=lambda key: int(key[len("thumb_"):])) if sized else thumbnails[0])
+
+        size = slackFile.get("size")
+        if self.maxBytes is not None and size is not None and size > self.maxBytes:
+            selected.difference_update(originals)
+
+        with self.lock:
+            for key in keys:
+                if (slackFile.get("id"), key) in self.seen:
+                    continue
+                self.seen.add((slackFile.get("id"), key))
+                # only the original file has a known size, thumbnails don't
+                keySize = (size or 0) if key in originals else 0
+                if key in selected:
+                    self.planned += 1
+                    self.plannedBytes += keySize
+                else:
+                    self.skipped += 1
+                    self.skippedBytes += keySize
+        return selected
+
+    def report(self):
+        with self.lock:
+            return {'planned': self.planned, 'planned_bytes': self.plannedBytes,
+                    'skipped': self.skipped, 'skipped_bytes': self.skippedBytes}
+
+
+# Records the files.slack.com files attached to messages of dayFile in the
+# manifest. With a downloader, their URLs are also pointed at local copies
+# under ../files.slack.com and each file is queued for download. Returns
+# whether any URL was changed.
+def localizeSlackFiles(messages, downloader, dayFile):
+    changed = False
+    for msg in messages:
+        for slackFile in msg.get("files", []):
+            # Skip deleted files
+            if slackFile.get("mode") == "tombstone":
+                continue
+
+            selected = None
+            if downloader is not None and filePolicy is not None:
+                selected = filePolicy.select(slackFile)
+
+            for key, value in slackFile.items():
+                # Find all entries referring to files on files.slack.com
+                if not isinstance(value, str) or not value.startswith("https://files.slack.com/"):
+                    continue
+                if selected is not None and key not in selected:
+                    continue
+
+                url = urlparse(value)
+
+                # Need to discard first "/" in URL, because:
+                localFile = os.path.join(
+                    "../files.slack.com", url.path[1:])
+                # "If a component is an absolute path, all previous components are thrown away and joining continues
+                # from the absolute path component."
+
+                fileId = slackFile.get("id", url.path)
+                # only the original file has a known size, thumbnails don't
+                size = slackFile.get("size") if key in ("url_private", "url_private_download") else None
+                if downloader is None:
+                    attachmentManifest.record(fileId, key, value, localFile, dayFile, False, size)
+                    continue
+
+                # Replace URL in data - suitable for use with slack-export-viewer if files.slack.com is linked
+                slackFile[key] = "/static/files.slack.com%s" % url.path
+                changed = True
+
+                attachmentManifest.record(fileId, key, value, localFile, dayFile, True, size)
+                downloader.submit(url.geturl(), localFile, size)
+
+    if downloader is not None:
+        attachmentManifest.localized(dayFile)
+    return changed
+
+
+def downloadFiles(downloader):
     """
-    Iterate through all json files, downloads files stored on files.slack.com and replaces the link with a local one
+    Downloads the files stored on files.slack.com that the export still needs,
+    using the attachment manifest rather than reading every json file.
 
-    Args:
-        jsonDirectory: folder where the json files are in, will be searched recursively
+    Day files written while a downloader was in place are already done; only
+    day files left by an earlier run without --downloadSlackFiles still link to
+    files.slack.com, and only those are rewritten. Downloads that were queued
+    or failed in an earlier run are retried without touching any json file.
     """
     print("Starting to download files")
-    for root, subdirs, files in os.walk("."):
-        for filename in files:
-            if not filename.endswith('.json'):
-                continue
-            filePath = os.path.join(root, filename)
-            data = []
-            with open(filePath) as inFile:
-                data = json.load(inFile)
-                for msg in data:
-                    for slackFile in msg.get("files", []):
-                        # Skip deleted files
-                        if slackFile.get("mode") == "tombstone":
-                            continue
-
-                        for key, value in slackFile.items():
-                            # Find all entries referring to files on files.slack.com
-                            if not isinstance(value, str) or not value.startswith("https://files.slack.com/"):
-                                continue
-
-                            url = urlparse(value)
-
-                            # Need to discard first "/" in URL, because:
-                            localFile = os.path.join(
-                                "../files.slack.com", url.path[1:])
-                            # "If a component is an absolute path, all previous components are thrown away and joining continues
-                            # from the absolute path component."
-                            print("Downloading %s, saving to %s" %
-                                  (url.geturl(), localFile))
-
-                            # Create folder structure
-                            os.makedirs(os.path.dirname(
-                                localFile), exist_ok=True)
-
-                            # Replace URL in data - suitable for use with slack-export-viewer if files.slack.com is linked
-                            slackFile[key] = "/static/files.slack.com%s" % url.path
-
-                            # Check if file already downloaded, with a non-zero size
-                            # (can't check for same size because thumbnails don't have a size)
-                            if os.path.exists(localFile) and (os.path.getsize(localFile) > 0):
-                                print(
-                                    "Skipping already downloaded file: %s" % localFile)
-                                continue
-
-                            # Download files
-                            headers = {"Authorization": f"Bearer {token}",
-                                       **cookie_header}
-                            r = requests.get(url.geturl(), headers=headers)
-                            try:
-                                open(localFile, 'wb').write(r.content)
-                            except FileNotFoundError:
-                                print("File writing error-still all broken")
-                                continue
-
-            # Save updated data to json file
-            with open(filePath, "w") as outFile:
-                json.dump(data, outFile, indent=4, sort_keys=True)
-
-            print("Replaced all files in %s" % filePath)
+    for filePath in attachmentManifest.remoteDayFiles():
+        data = readMessageFile(filePath)
+
+        localizeSlackFiles(data, downloader, filePath)
+
+        # Save updated data to json file
+        writeJsonFile(filePath, data)
+
+        print("Replaced all files in %s" % filePath)
+
+    for url, localFile, size in attachmentManifest.incompleteDownloads():
+        downloader.submit(url, localFile, size)
+
+
+# checks every downloaded file against the size Slack reported for it and
+# downloads the missing or corrupt ones again
+def verifyFiles(downloader):
+    print("Verifying downloaded files")
+    corrupt = 0
+    for url, localFile, size in attachmentManifest.downloadedFiles():
+        if isDownloaded(localFile, size):
+            continue
+        print("Corrupt or missing file: %s" % localFile)
+        corrupt += 1
+        if os.path.exists(localFile):
+            os.remove(localFile)
+        downloader.submit(url, localFile, size)
+    print("Found {0} corrupt or missing file{1}".format(corrupt, "" if corrupt == 1 else "s"))
+
+
+# parse a --rateLimit value of the form METHOD=PER_MINUTE[:BURST]
+def parseRateLimit(value):
+    try:
+        method, limit = value.split('=', 1)
+        perMinute, _, burst = limit.partition(':')
+        perMinute = float(perMinute)
+        return method, (perMinute, int(burst) if burst else max(1, int(perMinute / 10)))
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "expected METHOD=PER_MINUTE[:BURST], got '{0}'".format(value))
+
+
+def printRateLimiterReport():
+    waited = rateLimiter.report()
+    if not waited:
+        return
+    print("Waited {0:.1f}s on the rate limiter (summed over all threads):".format(
+        sum(waited.values())))
+    for method, seconds in sorted(waited.items()):
+        print("  {0}: {1:.1f}s".format(method, seconds))
+
+
+def printRetryReport():
+    for name, policy in (("API", retryPolicy), ("Download", downloadRetryPolicy)):
+        report = policy.report()
+        if report['retries'] or report['give_ups'] or report['breaker_trips']:
+            print("{0} requests: {1} retries, {2} given up for lack of retry budget, "
+                  "circuit opened {3} times".format(
+                      name, report['retries'], report['give_ups'], report['breaker_trips']))
+
+
+def printFilePolicyReport():
+    if fileDownloader is None or filePolicy is None:
+        return
+    report = filePolicy.report()
+    # thumbnails have no known size, the byte counts only cover original files
+    print("File policy: {0} downloads planned ({1:.1f} MB), {2} skipped ({3:.1f} MB saved)".format(
+        report['planned'], report['planned_bytes'] / (1024 * 1024),
+        report['skipped'], report['skipped_bytes'] / (1024 * 1024)))
+
+
+def printStageReport():
+    report = stageTimes.report()
+    if not report['fetch']:
+        return
+    print("Fetching history took {0:.1f}s and writing day files and checkpoints {1:.1f}s ({2}); "
+          "fetching waited {3:.1f}s for writes".format(
+              report['fetch'], report['write'],
+              "on {0} writer thread{1}".format(writerThreads, "" if writerThreads == 1 else "s")
+              if writerThreads else "on the fetching threads",
+              report['blocked']))
+
+
+def printConcurrencyReport():
+    report = concurrency.report()
+    print("Requests in flight: limit peaked at {0}, ended at {1} after {2} decrease{3}".format(
+        report['peak'], report['limit'], report['decreases'],
+        "" if report['decreases'] == 1 else "s"))
+
+
+def printCompressionReport(finalArchive):
+    if finalArchive.compressor is None:
+        return
+    report = finalArchive.compressor.report()
+    megabytes = report['bytes_in'] / (1024 * 1024)
+    # overall throughput is over the wall clock time spent compressing (an
+    # archive written during the export is mostly waiting for history);
+    # against the per thread figure it shows what the threads gain
+    print("Compressed {0:.1f} MB to {1:.1f} MB (ratio {2:.2f}) at {3:.1f} MB/s overall, "
+          "{4:.1f} MB/s per thread on {5} thread{6}".format(
+              megabytes, report['bytes_out'] / (1024 * 1024),
+              report['bytes_in'] / report['bytes_out'] if report['bytes_out'] else 0,
+              megabytes / report['busy_seconds'] if report['busy_seconds'] else 0,
+              megabytes / report['compress_seconds'] if report['compress_seconds'] else 0,
+              report['workers'], "" if report['workers'] == 1 else "s"))
 
 
 def finalize():
+    checkpoint.remove()
+    printRateLimiterReport()
+    printConcurrencyReport()
+    printRetryReport()
+    printFilePolicyReport()
+    printStageReport()
+    if sqliteExport is not None:
+        sqliteExport.close()
+        print("Wrote {0} messages to {1}".format(sqliteExport.written, sqliteExport.fileName))
+    if parquetExport is not None:
+        print("Wrote {0} messages to {1}".format(parquetExport.written, parquetExport.directory))
     os.chdir('..')
-    if zipName:
-        shutil.make_archive(zipName, 'zip', outputDirectory, None)
-        shutil.rmtree(outputDirectory)
+    if archiveName:
+        # the whole output directory, or only the directories and state files
+        # when the day files were written straight into the archive
+        finalArchive = archive if archive is not None else openArchive()
+        finalArchive.addTree(outputDirectory)
+        finalArchive.close()
+        print("Wrote {0}".format(finalArchive.fileName))
+        printCompressionReport(finalArchive)
+        # the next incremental export merges into this directory, keep it
+        if not incremental:
+            shutil.rmtree(outputDirectory)
     exit()
 
 
@@ -518,6 +2198,55 @@ if __name__ == "__main__":
     parser.add_argument(
         '--cookie', help="a set of cookies for the xoxc api token")
     parser.add_argument('--zip', help="Name of a zip file to output as")
+    parser.add_argument('--tar', help="Name of a tar file to output as")
+    parser.add_argument(
+        '--timezone',
+        metavar='TIMEZONE',
+        help="Time zone whose days the day files are for, e.g. 'Europe/Berlin' (default: UTC). "
+        "Keep it the same for every --incremental run into a directory")
+    parser.add_argument(
+        '--outputFormat',
+        choices=outputFormats,
+        default=outputFormat,
+        help="Write indented JSON day files that slack-export-viewer reads, compact JSON day files, "
+        "JSON Lines day files with a message per line, or one JSON Lines file per conversation "
+        "(default: %(default)s)")
+    parser.add_argument(
+        '--sqlite',
+        metavar='DATABASE',
+        help="Also write messages, users, channels and file references to a SQLite database, "
+        "with a full-text index on the message text. An existing database is updated")
+    parser.add_argument(
+        '--parquet',
+        metavar='DIRECTORY',
+        help="Also write messages to a Parquet dataset in DIRECTORY, one partition per conversation "
+        "(needs the pyarrow package)")
+    parser.add_argument(
+        '--jsonBackend',
+        choices=JsonCodec.BACKENDS,
+        default='auto',
+        help="JSON library that parses API responses and reads and writes files: orjson when it is "
+        "installed, or the standard library (default: %(default)s)")
+    parser.add_argument(
+        '--fastJson',
+        action='store_true',
+        default=False,
+        help="Also write files with orjson. They are no longer byte-identical to the standard library's: "
+        "non-ASCII characters are not escaped, and the viewer format is indented by 2 spaces")
+    parser.add_argument(
+        '--compression',
+        choices=('gz', 'xz', 'zstd'),
+        help="Compress the --tar file, in blocks on several threads (zstd needs the zstandard package)")
+    parser.add_argument(
+        '--compressionLevel',
+        type=int,
+        metavar='LEVEL',
+        help="Level of --compression (default: 6 for gz and xz, 3 for zstd)")
+    parser.add_argument(
+        '--compressionWorkers',
+        type=int,
+        metavar='N',
+        help="Number of threads compressing the --tar file (default: the number of CPUs)")
 
     parser.add_argument(
         '--dryRun',
@@ -571,6 +2300,156 @@ if __name__ == "__main__":
         default=False,
         help="Only export public channels if the user is a member of the channel")
 
+    parser.add_argument(
+        '--poolSize',
+        type=int,
+        default=DEFAULT_POOL_MAXSIZE,
+        metavar='N',
+        help="Number of keep-alive HTTP connections to keep open per host (default: %(default)s)")
+
+    parser.add_argument(
+        '--threadWorkers',
+        type=int,
+        default=threadWorkers,
+        metavar='N',
+        help="Number of threads fetching thread replies, shared by all conversations (default: %(default)s)")
+
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=exportWorkers,
+        metavar='N',
+        help="Number of conversations exported in parallel (default: %(default)s)")
+
+    parser.add_argument(
+        '--rateLimit',
+        type=parseRateLimit,
+        action='append',
+        default=[],
+        metavar='METHOD=PER_MINUTE[:BURST]',
+        help="Override the request rate (and bucket size) allowed for a Slack API method, "
+        "e.g. conversations.history=50:5. Defaults follow Slack's rate limit tiers")
+
+    parser.add_argument(
+        '--maxConcurrency',
+        type=int,
+        default=None,
+        metavar='N',
+        help="Upper bound on the number of API requests in flight. The actual number adapts: it grows "
+        "while responses are healthy and is halved on HTTP 429s or rising latency (default: --poolSize)")
+
+    parser.add_argument(
+        '--retries',
+        type=int,
+        default=5,
+        metavar='N',
+        help="Retry requests that fail with a timeout, a connection error or an HTTP 5xx "
+        "up to N times, with jittered exponential backoff (default: %(default)s)")
+
+    parser.add_argument(
+        '--timeout',
+        type=float,
+        default=DEFAULT_TIMEOUT,
+        metavar='SECONDS',
+        help="Timeout of the first attempt of each request; every retry waits 1.5 times longer "
+        "(default: %(default)s)")
+
+    parser.add_argument(
+        '--resume',
+        metavar='OUTPUT_DIRECTORY',
+        help="Carry on with an interrupted export in the given directory. "
+        "Pass the same conversation selection arguments as the interrupted run")
+
+    parser.add_argument(
+        '--incremental',
+        metavar='OUTPUT_DIRECTORY',
+        help="Export into the given directory, fetching only messages newer than the ones "
+        "exported there by the previous run and merging them into the existing day files")
+
+    parser.add_argument(
+        '--spillMessages',
+        type=int,
+        metavar='N',
+        help="Sort each conversation before writing it, so that every day file is written once. "
+        "Sorted runs of N messages are spilled to temporary files and merged at the end")
+
+    parser.add_argument(
+        '--spillMegabytes',
+        type=float,
+        metavar='MB',
+        help="Like --spillMessages, spilling once the buffered messages take up MB megabytes")
+
+    parser.add_argument(
+        '--spillDirectory',
+        metavar='DIRECTORY',
+        help="Where to put the temporary files of --spillMessages/--spillMegabytes "
+        "(default: the system's temporary directory)")
+
+    parser.add_argument(
+        '--writerThreads',
+        type=int,
+        default=writerThreads,
+        metavar='N',
+        help="Number of threads writing day files in the background, 0 writes them on the threads "
+        "that fetch the history (default: %(default)s)")
+
+    parser.add_argument(
+        '--downloadWorkers',
+        type=int,
+        default=downloadWorkers,
+        metavar='N',
+        help="Number of files downloaded in parallel by --downloadSlackFiles (default: %(default)s)")
+
+    parser.add_argument(
+        '--downloadBandwidth',
+        type=float,
+        metavar='MB_PER_SECOND',
+        help="Cap the combined bandwidth of --downloadSlackFiles")
+
+    parser.add_argument(
+        '--fileVariants',
+        choices=FilePolicy.variants,
+        default='all',
+        help="Which variants of each file --downloadSlackFiles downloads: every URL Slack lists "
+        "(the original and all thumbnails), the original only, the largest thumbnail only, "
+        "or both of the latter (default: %(default)s)")
+
+    parser.add_argument(
+        '--maxFileSize',
+        type=float,
+        metavar='MB',
+        help="Don't download original files larger than MB megabytes")
+
+    parser.add_argument(
+        '--fileTypes',
+        metavar='MIME_TYPES',
+        help="Only download files with one of these comma separated MIME types, which may "
+        "contain wildcards, e.g. 'image/*,application/pdf'")
+
+    parser.add_argument(
+        '--excludeFileTypes',
+        metavar='MIME_TYPES',
+        help="Don't download files with one of these comma separated MIME types, e.g. 'video/*'")
+
+    parser.add_argument(
+        '--blobStore',
+        metavar='DIRECTORY',
+        help="Keep downloaded files in a content-addressed store shared by all exports using the same "
+        "DIRECTORY, and hardlink them into the export; files already in the store are not downloaded again")
+
+    parser.add_argument(
+        '--symlinkBlobs',
+        action='store_true',
+        default=False,
+        help="Symlink files from --blobStore instead of hardlinking them")
+
+    parser.add_argument(
+        '--verifyFiles',
+        action='store_true',
+        default=False,
+        help="After downloading, check every downloaded file against the size Slack reported for it "
+        "and download the missing or corrupt ones again (implies --downloadSlackFiles)")
+
     args = parser.parse_args()
 
     users = []
@@ -580,24 +2459,103 @@ if __name__ == "__main__":
     userNamesById = {}
     userIdsByName = {}
 
+    try:
+        jsonCodec = JsonCodec(args.jsonBackend, compatible=not args.fastJson)
+    except ValueError as e:
+        parser.error("--jsonBackend: {0} (pip install orjson)".format(e))
+
     cookie_header = {'cookie': args.cookie}
-    slack = Slacker(headers=cookie_header, token=args.token)
+    rateLimiter = RateLimiter(dict(args.rateLimit))
+    concurrency = ConcurrencyController(
+        maximum=args.maxConcurrency or args.poolSize, log=print)
+    retryPolicy = RetryPolicy(max_attempts=args.retries + 1, log=print)
+    # files.slack.com sends 429s that Slacker does not see, retry those too
+    downloadRetryPolicy = RetryPolicy(
+        max_attempts=args.retries + 1, retry_statuses=RETRY_STATUSES + (429,), log=print)
+    timeout = args.timeout
+    slack = Slacker(headers=cookie_header, token=args.token, timeout=timeout,
+                    pool_maxsize=args.poolSize, rate_limiter=rateLimiter,
+                    concurrency=concurrency, retry_policy=retryPolicy, json_codec=jsonCodec)
     testAuth = doTestAuth()
     tokenOwnerId = testAuth['user_id']
 
     bootstrapKeyValues(args)
 
     dryRun = args.dryRun
-    zipName = args.zip
-
-    outputDirectory = "{0}-slack_export".format(
-        datetime.today().strftime("%Y%m%d-%H%M%S"))
-    mkdir(outputDirectory)
+    threadWorkers = args.threadWorkers
+    exportWorkers = args.workers
+    writerThreads = args.writerThreads
+    downloadWorkers = args.downloadWorkers
+    downloadBytesPerSecond = args.downloadBandwidth and args.downloadBandwidth * 1024 * 1024
+    spillMessages = args.spillMessages
+    spillBytes = int(args.spillMegabytes * 1024 * 1024) if args.spillMegabytes else None
+    spillDirectory = args.spillDirectory and os.path.abspath(args.spillDirectory)
+    if args.zip and args.tar:
+        parser.error("--zip and --tar are exclusive")
+    outputFormat = args.outputFormat
+    if args.timezone:
+        try:
+            dayBuckets = DayBuckets(zoneinfo.ZoneInfo(args.timezone))
+        except (zoneinfo.ZoneInfoNotFoundError, ValueError):
+            parser.error("--timezone: unknown time zone {0}".format(args.timezone))
+    sqliteFile = args.sqlite and os.path.abspath(args.sqlite)
+    if args.parquet and pyarrow is None:
+        parser.error("--parquet needs the pyarrow package (pip install pyarrow)")
+    if args.parquet and not args.dryRun:
+        parquetExport = ParquetExport(os.path.abspath(args.parquet))
+    archiveName = args.zip or args.tar
+    archiveFormat = 'zip' if args.zip else 'tar'
+    if args.compression and not args.tar:
+        parser.error("--compression needs --tar")
+    if args.compression == 'zstd' and zstandard is None:
+        parser.error("--compression zstd needs the zstandard package (pip install zstandard)")
+    archiveCompression = args.compression
+    compressionLevel = args.compressionLevel
+    compressionWorkers = args.compressionWorkers
+    filePolicy = FilePolicy(
+        args.fileVariants,
+        int(args.maxFileSize * 1024 * 1024) if args.maxFileSize else None,
+        [mimeType.strip().lower() for mimeType in (args.fileTypes or '').split(',') if mimeType.strip()],
+        [mimeType.strip().lower() for mimeType in (args.excludeFileTypes or '').split(',') if mimeType.strip()])
+    if args.blobStore:
+        blobStore = BlobStore(os.path.abspath(args.blobStore), args.symlinkBlobs)
+
+    incremental = args.incremental is not None
+    if args.resume and incremental:
+        parser.error("--resume and --incremental are exclusive, "
+                     "an interrupted incremental export resumes by itself")
+
+    if args.resume:
+        outputDirectory = os.path.abspath(args.resume)
+        print("Resuming export in {0}".format(outputDirectory))
+    elif incremental:
+        outputDirectory = os.path.abspath(args.incremental)
+        mkdir(outputDirectory)
+        print("Incremental export into {0}".format(outputDirectory))
+    elif archiveName:
+        # the day files go straight into the archive, only the state files
+        # of the export are kept in a scratch directory until the end
+        archive = openArchive()
+        outputDirectory = tempfile.mkdtemp(prefix='.slack_export-', dir=os.getcwd())
+        print("Exporting into {0}".format(archive.fileName))
+    else:
+        outputDirectory = os.path.abspath("{0}-slack_export".format(
+            datetime.today().strftime("%Y%m%d-%H%M%S")))
+        mkdir(outputDirectory)
     os.chdir(outputDirectory)
+    checkpoint = CheckpointJournal()
+    highWaterMarks = HighWaterMarks()
+    attachmentManifest = AttachmentManifest()
 
     if not dryRun:
         dumpUserFile()
         dumpChannelFile()
+        if args.sqlite:
+            sqliteExport = SQLiteExport(sqliteFile)
+            sqliteExport.addUsers(users)
+            sqliteExport.addChannels(channels, 'channel')
+            sqliteExport.addChannels(groups, 'group')
+            sqliteExport.addChannels(dms, 'im')
 
     selectedChannels = selectConversations(
         channels,
@@ -620,18 +2578,33 @@ if __name__ == "__main__":
         filterDirectMessagesByUserNameOrId,
         promptForDirectMessages)
 
+    if (args.downloadSlackFiles or args.verifyFiles) and not dryRun:
+        fileDownloader = FileDownloader(
+            slack.session, {"Authorization": f"Bearer {args.token}", **cookie_header},
+            downloadRetryPolicy, timeout, downloadWorkers, downloadBytesPerSecond,
+            attachmentManifest, blobStore)
+
+    jobs = []
+
     if len(selectedChannels) > 0:
-        fetchPublicChannels(selectedChannels)
+        jobs.extend(fetchPublicChannels(selectedChannels))
 
     if len(selectedGroups) > 0:
         if len(selectedChannels) == 0:
             dumpDummyChannel()
-        fetchGroups(selectedGroups)
+        jobs.extend(fetchGroups(selectedGroups))
 
     if len(selectedDms) > 0:
-        fetchDirectMessages(selectedDms)
+        jobs.extend(fetchDirectMessages(selectedDms))
+
+    exportConversations(jobs)
 
-    if args.downloadSlackFiles:
-        downloadFiles(token=args.token, cookie_header=cookie_header)
+    if fileDownloader is not None:
+        downloadFiles(fileDownloader)
+        if args.verifyFiles:
+            fileDownloader.wait()
+            verifyFiles(fileDownloader)
+        fileDownloader.close()
+    attachmentManifest.save()
 
     finalize()
@@ -17,8 +17,16 @@
 # limitations under the License.
 
 import json
-from time import sleep
+import random
+import threading
+from time import monotonic, sleep
 import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 ###### Slacker Utils ######
 
@@ -50,6 +58,30 @@ DEFAULT_TIMEOUT = 10
 DEFAULT_RETRIES = 0
 # seconds to wait after a 429 error if Slack's API doesn't provide one
 DEFAULT_WAIT = 20
+# number of distinct hosts and of keep-alive connections per host kept open
+DEFAULT_POOL_CONNECTIONS = 4
+DEFAULT_POOL_MAXSIZE = 16
+
+# requests per minute allowed by each of Slack's rate limit tiers, see
+# https://api.slack.com/docs/rate-limits
+RATE_LIMIT_TIERS = {1: 1, 2: 20, 3: 50, 4: 100}
+# tier of the methods used by the exporter; other methods use DEFAULT_TIER
+METHOD_TIERS = {
+    'auth.test': 4,
+    'users.list': 2,
+    'conversations.list': 2,
+    'conversations.info': 3,
+    'conversations.history': 3,
+    'conversations.replies': 3,
+    'conversations.members': 4,
+}
+DEFAULT_TIER = 3
+
+# transient failures that are worth another attempt
+RETRY_STATUSES = (500, 502, 503, 504)
+RETRY_EXCEPTIONS = (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout,
+                    requests.exceptions.ChunkedEncodingError)
 
 __all__ = ['Error', 'Response', 'BaseAPI', 'API', 'Auth', 'Users', 'Groups',
            'Channels', 'Chat', 'IM', 'IncomingWebhook', 'Search', 'Files',
@@ -57,17 +89,70 @@ __all__ = ['Error', 'Response', 'BaseAPI', 'API', 'Auth', 'Users', 'Groups',
            'UserGroups', 'UserGroupsUsers', 'MPIM', 'OAuth', 'DND', 'Bots',
            'FilesComments', 'Reminders', 'TeamProfile', 'UsersProfile',
            'IDPGroups', 'Apps', 'AppsPermissions', 'Slacker', 'Dialog',
-           'Conversations', 'Migration']
+           'Conversations', 'Migration', 'PooledSession', 'TokenBucket',
+           'RateLimiter', 'ConcurrencyController', 'RetryPolicy',
+           'JsonCodec']
 
 
 class Error(Exception):
     pass
 
 
+# Patched
+# JSON parsing and serialization with an optional fast backend
+class JsonCodec(object):
+    """
+    Parses and serializes JSON with orjson when it is installed, and with
+    the standard library otherwise.
+
+    In compatible mode (the default) ``dumps`` always uses the standard
+    library, so files written are byte-identical whichever backend is
+    installed; parsing, which yields the same objects either way, still uses
+    the fast backend. Without it orjson also serializes: its output is UTF-8
+    rather than ``\\u`` escaped, and it only indents by 2 spaces.
+    """
+
+    BACKENDS = ('auto', 'json', 'orjson')
+
+    def __init__(self, backend='auto', compatible=True):
+        if backend == 'auto':
+            backend = 'json' if orjson is None else 'orjson'
+        if backend == 'orjson' and orjson is None:
+            raise ValueError('the orjson backend needs the orjson package')
+        self.backend = backend
+        self.compatible = compatible
+
+    def loads(self, data):
+        if self.backend == 'orjson':
+            try:
+                return orjson.loads(data)
+            except orjson.JSONDecodeError:
+                # orjson rejects some valid documents, such as integers
+                # beyond 64 bits; the standard library decides
+                pass
+        return json.loads(data)
+
+    def dumps(self, obj, indent=None):
+        """Returns obj as a str, compact unless indent is given."""
+        if self.backend == 'orjson' and not self.compatible:
+            try:
+                return orjson.dumps(
+                    obj, option=orjson.OPT_INDENT_2 if indent else 0
+                ).decode('utf-8')
+            except TypeError:
+                pass
+        if indent:
+            return json.dumps(obj, indent=indent)
+        return json.dumps(obj, separators=(',', ':'))
+
+
+DEFAULT_JSON_CODEC = JsonCodec('json')
+
+
 class Response(object):
-    def __init__(self, body):
+    def __init__(self, body, json_codec=DEFAULT_JSON_CODEC):
         self.raw = body
-        self.body = json.loads(body)
+        self.body = json_codec.loads(body)
         self.successful = self.body['ok']
         self.error = self.body.get('error')
 
@@ -75,17 +160,438 @@ class Response(object):
         return json.dumps(self.body)
 
 
+# Patched
+# Keep-alive connection pool shared by every API namespace and every thread
+class PooledSession(object):
+    """
+    Drop-in replacement for ``requests.Session`` that is safe to share
+    between threads.
+
+    Each thread gets its own ``requests.Session`` (sessions carry mutable
+    cookie and header state), but all of them are mounted on one
+    ``HTTPAdapter``, so TCP/TLS connections are pooled and reused across
+    the whole process.
+
+    :param pool_connections: Number of hosts to keep a connection pool for
+    :param pool_maxsize: Maximum number of keep-alive connections per host
+    :param pool_block: Wait for a free connection instead of opening an
+        extra, non-pooled one when the pool is exhausted
+    :param keep_alive: Set to False to close connections after each request
+    """
+
+    def __init__(self, pool_connections=DEFAULT_POOL_CONNECTIONS,
+                 pool_maxsize=DEFAULT_POOL_MAXSIZE, pool_block=True,
+                 keep_alive=True):
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.keep_alive = keep_alive
+        self.adapter = HTTPAdapter(pool_connections=pool_connections,
+                                   pool_maxsize=pool_maxsize,
+                                   pool_block=pool_block)
+        self._local = threading.local()
+
+    def _session(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            session.mount('https://', self.adapter)
+            session.mount('http://', self.adapter)
+            if not self.keep_alive:
+                session.headers['Connection'] = 'close'
+            self._local.session = session
+        return session
+
+    def request(self, method, url, **kwargs):
+        return self._session().request(method=method, url=url, **kwargs)
+
+    def get(self, url, **kwargs):
+        kwargs.setdefault('allow_redirects', True)
+        return self.request('get', url, **kwargs)
+
+    def post(self, url, data=None, **kwargs):
+        return self.request('post', url, data=data, **kwargs)
+
+    def close(self):
+        self.adapter.close()
+
+
+# Patched
+# Proactive, thread-safe rate limiting keyed on the Slack API method
+class TokenBucket(object):
+    """
+    Token bucket refilled at ``per_minute`` tokens per minute and holding at
+    most ``capacity`` tokens.
+
+    Waiting callers reserve their token before sleeping, so concurrent
+    threads are served in arrival order at exactly the configured rate.
+    """
+
+    def __init__(self, per_minute, capacity=1):
+        self.rate = per_minute / 60.0
+        self.capacity = max(1, capacity)
+        self.tokens = float(self.capacity)
+        self.updated = monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, tokens=1):
+        """Takes ``tokens`` tokens, sleeping until they are available.
+
+        :returns: Seconds spent waiting
+        """
+        with self.lock:
+            self._refill(monotonic())
+            self.tokens -= tokens
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait > 0:
+            sleep(wait)
+        return wait
+
+    def pause(self, seconds):
+        """Empties the bucket so nobody gets a token for ``seconds``."""
+        with self.lock:
+            self._refill(monotonic())
+            self.tokens = min(self.tokens, -seconds * self.rate)
+
+
+class RateLimiter(object):
+    """
+    One token bucket per Slack API method, shared by every thread.
+
+    :param limits: Mapping of method name to ``(per_minute, capacity)``
+        overriding the tier defaults
+    :param burst_seconds: Default bucket size, in seconds worth of requests
+    """
+
+    def __init__(self, limits=None, burst_seconds=6):
+        self.limits = dict(limits or {})
+        self.burst_seconds = burst_seconds
+        self.buckets = {}
+        self.waited = {}
+        self.lock = threading.Lock()
+
+    def _bucket(self, method):
+        with self.lock:
+            bucket = self.buckets.get(method)
+            if bucket is None:
+                if method in self.limits:
+                    per_minute, capacity = self.limits[method]
+                else:
+                    tier = METHOD_TIERS.get(method, DEFAULT_TIER)
+                    per_minute = RATE_LIMIT_TIERS[tier]
+                    capacity = int(per_minute * self.burst_seconds / 60)
+                bucket = self.buckets[method] = TokenBucket(per_minute,
+                                                            capacity)
+            return bucket
+
+    def acquire(self, method):
+        wait = self._bucket(method).acquire()
+        if wait:
+            with self.lock:
+                self.waited[method] = self.waited.get(method, 0.0) + wait
+        return wait
+
+    def pause(self, method, seconds):
+        self._bucket(method).pause(seconds)
+
+    def total_wait(self):
+        with self.lock:
+            return sum(self.waited.values())
+
+    def report(self):
+        """Returns ``{method: seconds spent waiting}``."""
+        with self.lock:
+            return dict(self.waited)
+
+
+# Patched
+# Adaptive limit on the number of requests in flight
+class ConcurrencyController(object):
+    """
+    AIMD (additive increase, multiplicative decrease) limit on the number of
+    requests in flight at once, shared by every thread.
+
+    While responses are healthy the limit grows by ``increase`` per
+    ``limit`` successful responses (about one slot per round trip). A 429,
+    or a method's average latency rising above ``latency_tolerance`` times
+    the best average seen for it, multiplies the limit by ``decrease``. At
+    most one decrease happens per ``cooldown`` seconds, so a burst of
+    throttled responses to requests that were already in flight counts
+    once.
+
+    :param log: Optional callable receiving a message whenever the limit is
+        decreased
+    """
+
+    def __init__(self, initial=4, minimum=1, maximum=DEFAULT_POOL_MAXSIZE,
+                 increase=1.0, decrease=0.5, latency_tolerance=2.0,
+                 cooldown=1.0, log=None):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = float(max(minimum, min(initial, maximum)))
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_tolerance = latency_tolerance
+        self.cooldown = cooldown
+        self.log = log
+        self.in_flight = 0
+        self.latency = {}
+        self.best_latency = {}
+        self.last_decrease = 0.0
+        self.decreases = 0
+        self.peak = self.limit
+        self.history = [(monotonic(), self.limit)]
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self, method, latency, failure=None):
+        """Frees a slot and adjusts the limit.
+
+        :param failure: Why the request failed (e.g. ``'HTTP 429'``), or None
+        """
+        with self.condition:
+            self.in_flight -= 1
+            reason = failure or self._observe(method, latency)
+            if reason:
+                self._decrease(reason)
+            else:
+                self.limit = min(self.maximum,
+                                 self.limit + self.increase / self.limit)
+                self.peak = max(self.peak, self.limit)
+            self.condition.notify_all()
+
+    def _observe(self, method, latency):
+        # exponentially weighted average, compared with the best seen so far
+        average = self.latency.get(method, latency) * 0.8 + latency * 0.2
+        self.latency[method] = average
+        best = self.best_latency[method] = min(
+            self.best_latency.get(method, average), average)
+        if average > best * self.latency_tolerance:
+            return 'latency of {0} rose to {1:.2f}s'.format(method, average)
+        return None
+
+    def _decrease(self, reason):
+        now = monotonic()
+        if now - self.last_decrease < self.cooldown:
+            return
+        self.last_decrease = now
+        self.decreases += 1
+        self.limit = max(self.minimum, self.limit * self.decrease)
+        self.history.append((now, self.limit))
+        if self.log is not None:
+            self.log('{0}: reducing concurrency to {1}'.format(
+                reason, int(self.limit)))
+
+    def report(self):
+        """Returns a summary of how the limit behaved."""
+        with self.condition:
+            return {
+                'limit': int(self.limit),
+                'peak': int(self.peak),
+                'decreases': self.decreases,
+            }
+
+
+# Patched
+# Retries with capped, jittered exponential backoff and a circuit breaker
+class RetryPolicy(object):
+    """
+    Retries transient failures (``RETRY_EXCEPTIONS`` and ``retry_statuses``).
+
+    - Attempt ``n`` (from 0) sleeps a random time between 0 and
+      ``min(max_delay, base_delay * 2 ** n)`` first ("full jitter"), or the
+      server's Retry-After if it sent one.
+    - Attempt ``n`` uses a timeout of ``timeout * timeout_growth ** n``,
+      capped at ``max_timeout``.
+    - Retries are paid for from a budget shared by every caller. Each
+      success adds ``budget_ratio`` tokens, up to ``budget``, so a wide
+      outage cannot turn into a retry storm.
+    - After ``breaker_threshold`` consecutive failures the circuit opens.
+      Every caller then waits ``breaker_reset`` seconds before the next
+      probe.
+
+    One instance can be shared by any number of threads.
+
+    :param log: Optional callable receiving a message for every retry
+    """
+
+    def __init__(self, max_attempts=6, base_delay=1.0, max_delay=60.0,
+                 timeout_growth=1.5, max_timeout=120.0,
+                 retry_statuses=RETRY_STATUSES, budget=100, budget_ratio=0.2,
+                 breaker_threshold=10, breaker_reset=30.0, log=None):
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.timeout_growth = timeout_growth
+        self.max_timeout = max_timeout
+        self.retry_statuses = tuple(retry_statuses)
+        self.budget = budget
+        self.budget_ratio = budget_ratio
+        self.tokens = float(budget)
+        self.breaker_threshold = breaker_threshold
+        self.breaker_reset = breaker_reset
+        self.log = log
+        self.failures = 0
+        self.open_until = 0.0
+        self.retries = 0
+        self.give_ups = 0
+        self.breaker_trips = 0
+        self.lock = threading.Lock()
+
+    def timeout(self, attempt, timeout):
+        if timeout is None:
+            return None
+        return min(self.max_timeout, timeout * self.timeout_growth ** attempt)
+
+    def delay(self, attempt, response=None):
+        if response is not None and 'retry-after' in response.headers:
+            try:
+                return float(response.headers['retry-after'])
+            except ValueError:
+                pass
+        return random.uniform(0, min(self.max_delay,
+                                     self.base_delay * 2 ** attempt))
+
+    def _wait_for_breaker(self):
+        with self.lock:
+            wait = self.open_until - monotonic()
+        if wait > 0:
+            sleep(wait)
+
+    def _record(self, success):
+        with self.lock:
+            if success:
+                self.failures = 0
+                self.tokens = min(self.budget, self.tokens + self.budget_ratio)
+                return
+            self.failures += 1
+            if self.failures >= self.breaker_threshold:
+                self.failures = 0
+                self.breaker_trips += 1
+                self.open_until = monotonic() + self.breaker_reset
+                if self.log is not None:
+                    self.log('circuit open: pausing requests for {0:.0f}s'
+                             .format(self.breaker_reset))
+
+    def _spend_retry(self):
+        with self.lock:
+            if self.tokens < 1:
+                self.give_ups += 1
+                return False
+            self.tokens -= 1
+            self.retries += 1
+            return True
+
+    def call(self, attempt_request, timeout=DEFAULT_TIMEOUT, description=''):
+        """
+        Calls ``attempt_request(timeout)`` until it returns a response whose
+        status is not retryable, or attempts or budget run out.
+
+        :returns: The last response, which may still be an error status
+        :raises: The last exception if the final attempt raised
+        """
+        attempt = 0
+        while True:
+            self._wait_for_breaker()
+            response = None
+            try:
+                response = attempt_request(self.timeout(attempt, timeout))
+            except RETRY_EXCEPTIONS as e:
+                failure = e
+            else:
+                if response.status_code not in self.retry_statuses:
+                    self._record(True)
+                    return response
+                failure = 'HTTP {0}'.format(response.status_code)
+            self._record(False)
+
+            attempt += 1
+            if attempt >= self.max_attempts or not self._spend_retry():
+                if response is not None:
+                    return response
+                raise failure
+
+            delay = self.delay(attempt - 1, response)
+            if self.log is not None:
+                self.log('{0} failed ({1}), retry {2}/{3} in {4:.1f}s'.format(
+                    description or 'request', failure, attempt,
+                    self.max_attempts - 1, delay))
+            sleep(delay)
+
+    def report(self):
+        with self.lock:
+            return {
+                'retries': self.retries,
+                'give_ups': self.give_ups,
+                'breaker_trips': self.breaker_trips,
+            }
+
+
 # Patched
 # Pass the headers along to the requests call
 class BaseAPI(object):
     def __init__(self, token=None, headers=None, timeout=DEFAULT_TIMEOUT, proxies=None,
-                 session=None, rate_limit_retries=DEFAULT_RETRIES):
+                 session=None, rate_limit_retries=DEFAULT_RETRIES,
+                 rate_limiter=None, concurrency=None, retry_policy=None,
+                 json_codec=DEFAULT_JSON_CODEC):
         self.headers = headers
         self.token = token
         self.timeout = timeout
         self.proxies = proxies
         self.session = session
         self.rate_limit_retries = rate_limit_retries
+        self.rate_limiter = rate_limiter
+        self.concurrency = concurrency
+        self.retry_policy = retry_policy
+        self.json_codec = json_codec
+
+    def _send(self, request_method, url, method, **kwargs):
+        if self.retry_policy is None:
+            return self._attempt(request_method, url, method, self.timeout,
+                                 **kwargs)
+        return self.retry_policy.call(
+            lambda timeout: self._attempt(request_method, url, method,
+                                          timeout, **kwargs),
+            self.timeout, method)
+
+    def _attempt(self, request_method, url, method, timeout, **kwargs):
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire(method)
+        if self.concurrency is None:
+            response = request_method(
+                url, timeout=timeout, proxies=self.proxies, **kwargs
+            )
+        else:
+            self.concurrency.acquire()
+            started = monotonic()
+            # timeouts and connection errors are a congestion signal too
+            failure = 'request error'
+            try:
+                response = request_method(
+                    url, timeout=timeout, proxies=self.proxies, **kwargs
+                )
+                if response.status_code == requests.codes.too_many:
+                    failure = 'HTTP 429'
+                else:
+                    failure = None
+            finally:
+                self.concurrency.release(method, monotonic() - started,
+                                         failure)
+        # a 429 applies to every caller of this method, not only this one
+        if (self.rate_limiter is not None and
+                response.status_code == requests.codes.too_many):
+            self.rate_limiter.pause(method, int(
+                response.headers.get('retry-after', DEFAULT_WAIT)))
+        return response
 
     def _request(self, request_method, method, **kwargs):
         if self.token:
@@ -96,9 +602,7 @@ class BaseAPI(object):
         # while we have rate limit retries left, fetch the resource and back
         # off as Slack's HTTP response suggests
         for retry_num in range(self.rate_limit_retries):
-            response = request_method(
-                url, timeout=self.timeout, proxies=self.proxies, **kwargs
-            )
+            response = self._send(request_method, url, method, **kwargs)
 
             if response.status_code == requests.codes.ok:
                 break
@@ -115,12 +619,10 @@ class BaseAPI(object):
         else:
             # with no retries left, make one final attempt to fetch the
             # resource, but do not handle too_many status differently
-            response = request_method(
-                url, timeout=self.timeout, proxies=self.proxies, **kwargs
-            )
+            response = self._send(request_method, url, method, **kwargs)
             response.raise_for_status()
 
-        response = Response(response.text)
+        response = Response(response.text, self.json_codec)
         if not response.successful:
             raise Error(response.error)
 
@@ -1217,9 +1719,18 @@ class Slacker(object):
 
     def __init__(self, token, headers=None, incoming_webhook_url=None,
                  timeout=DEFAULT_TIMEOUT, http_proxy=None, https_proxy=None,
-                 session=None, rate_limit_retries=DEFAULT_RETRIES):
+                 session=None, rate_limit_retries=DEFAULT_RETRIES,
+                 pool_connections=DEFAULT_POOL_CONNECTIONS,
+                 pool_maxsize=DEFAULT_POOL_MAXSIZE, rate_limiter=None,
+                 concurrency=None, retry_policy=None,
+                 json_codec=DEFAULT_JSON_CODEC):
 
         proxies = self.__create_proxies(http_proxy, https_proxy)
+        # Without a session every call would open a new TCP+TLS connection
+        if session is None:
+            session = PooledSession(pool_connections=pool_connections,
+                                    pool_maxsize=pool_maxsize)
+        self.session = session
         api_args = {
             'headers': headers,
             'token': token,
@@ -1227,7 +1738,14 @@ class Slacker(object):
             'proxies': proxies,
             'session': session,
             'rate_limit_retries': rate_limit_retries,
+            'rate_limiter': rate_limiter,
+            'concurrency': concurrency,
+            'retry_policy': retry_policy,
+            'json_codec': json_codec,
         }
+        self.retry_policy = retry_policy
+        self.rate_limiter = rate_limiter
+        self.concurrency = concurrency
         self.im = IM(**api_args)
         self.api = API(**api_args)
         self.dnd = DND(**api_args)
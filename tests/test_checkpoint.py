@@ -0,0 +1,126 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from slack_export import CheckpointJournal
+
+
+def page(number):
+    return [{'ts': '%d.000000' % number, 'text': 'message %d' % number}]
+
+
+# Simulates crashes at every point of saving a page by writing what an
+# interrupted run would leave behind, then checks what a resumed run reads
+# back. Without writer threads, submitPage appends the page right away.
+class CheckpointJournalTest(unittest.TestCase):
+    def setUp(self):
+        self.previousDirectory = os.getcwd()
+        self.directory = tempfile.mkdtemp()
+        os.chdir(self.directory)
+
+    def tearDown(self):
+        os.chdir(self.previousDirectory)
+        shutil.rmtree(self.directory)
+
+    def reopen(self, checkpoint):
+        checkpoint.journal.close()
+        return CheckpointJournal()
+
+    def restored(self, checkpoint, conversationId='C1'):
+        return list(checkpoint.restorePages(conversationId))
+
+    def appendToSpool(self, data, conversationId='C1'):
+        with open(os.path.join(CheckpointJournal.spoolDirectory, conversationId + '.jsonl'), 'ab') as spool:
+            spool.write(data)
+
+    def test_resume_restores_saved_pages(self):
+        checkpoint = CheckpointJournal()
+        checkpoint.submitPage('C1', page(1), 'cursor1')
+        checkpoint.submitPage('C1', page(2), None)
+
+        checkpoint = self.reopen(checkpoint)
+        self.assertEqual(self.restored(checkpoint), [page(1), page(2)])
+        self.assertEqual(checkpoint.resumeCursor('C1'), "")
+
+    def test_spool_line_without_journal_record_is_dropped(self):
+        checkpoint = CheckpointJournal()
+        checkpoint.submitPage('C1', page(1), 'cursor1')
+        checkpoint.journal.close()
+        # crash after the spool line of page 2, before its journal record
+        self.appendToSpool(b'[{"ts": "2.000000", "text": "orphan"}]\n')
+
+        checkpoint = CheckpointJournal()
+        self.assertEqual(self.restored(checkpoint), [page(1)])
+        self.assertEqual(checkpoint.resumeCursor('C1'), 'cursor1')
+
+        # the resumed run fetches page 2 again and crashes once more
+        checkpoint.submitPage('C1', page(2), 'cursor2')
+        checkpoint = self.reopen(checkpoint)
+        self.assertEqual(self.restored(checkpoint), [page(1), page(2)])
+        self.assertEqual(checkpoint.resumeCursor('C1'), 'cursor2')
+
+    def test_torn_spool_line_is_cut_off(self):
+        checkpoint = CheckpointJournal()
+        checkpoint.submitPage('C1', page(1), 'cursor1')
+        checkpoint.journal.close()
+        # crash in the middle of writing the spool line of page 2
+        self.appendToSpool(b'[{"ts": "2.0000')
+
+        checkpoint = CheckpointJournal()
+        self.assertEqual(self.restored(checkpoint), [page(1)])
+        checkpoint.submitPage('C1', page(2), 'cursor2')
+
+        checkpoint = self.reopen(checkpoint)
+        self.assertEqual(self.restored(checkpoint), [page(1), page(2)])
+
+    def test_records_after_a_torn_journal_record_are_kept(self):
+        checkpoint = CheckpointJournal()
+        checkpoint.submitPage('C1', page(1), 'cursor1')
+        checkpoint.journal.close()
+        # crash in the middle of writing the journal record of page 2
+        with open(CheckpointJournal.fileName, 'ab') as journal:
+            journal.write(b'{"id": "C1", "pag')
+
+        checkpoint = CheckpointJournal()
+        self.assertEqual(self.restored(checkpoint), [page(1)])
+        checkpoint.submitPage('C1', page(2), 'cursor2')
+        checkpoint.submitPage('C2', page(3), None)
+        checkpoint.markDone('C2')
+
+        checkpoint = self.reopen(checkpoint)
+        self.assertEqual(self.restored(checkpoint), [page(1), page(2)])
+        self.assertEqual(checkpoint.resumeCursor('C1'), 'cursor2')
+        self.assertTrue(checkpoint.isDone('C2'))
+
+    def test_spool_without_any_journal_record_starts_from_scratch(self):
+        checkpoint = CheckpointJournal()
+        checkpoint.journal.close()
+        os.makedirs(CheckpointJournal.spoolDirectory)
+        # crash after the spool line of the first page, before its journal record
+        self.appendToSpool(b'[{"ts": "1.000000", "text": "orphan"}]\n')
+
+        checkpoint = CheckpointJournal()
+        self.assertIsNone(checkpoint.resumeCursor('C1'))
+        self.assertEqual(self.restored(checkpoint), [])
+        checkpoint.submitPage('C1', page(1), 'cursor1')
+
+        checkpoint = self.reopen(checkpoint)
+        self.assertEqual(self.restored(checkpoint), [page(1)])
+
+    def test_finished_conversation_is_skipped(self):
+        checkpoint = CheckpointJournal()
+        checkpoint.submitPage('C1', page(1), None)
+        checkpoint.markDone('C1')
+
+        checkpoint = self.reopen(checkpoint)
+        self.assertTrue(checkpoint.isDone('C1'))
+        self.assertEqual(self.restored(checkpoint), [])
+        self.assertFalse(os.path.exists(checkpoint.spoolFile('C1')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+import http.server
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from slack_export import AttachmentManifest, FileDownloader
+from slacker import RetryPolicy
+
+CONTENT = bytes(range(256)) * 64
+
+
+# Serves CONTENT with an ETag, honouring Range and If-Range the way
+# files.slack.com does, and records the Range header of every request.
+class FileHandler(http.server.BaseHTTPRequestHandler):
+    etag = '"v1"'
+    ranges = []
+
+    def do_GET(self):
+        byteRange = self.headers.get('Range')
+        self.ranges.append(byteRange)
+        ifRange = self.headers.get('If-Range')
+        if byteRange is None or (ifRange is not None and ifRange != self.etag):
+            self.send(200, CONTENT)
+            return
+
+        offset = int(byteRange[len('bytes='):].rstrip('-'))
+        if offset >= len(CONTENT):
+            self.send(416, b'', {'Content-Range': 'bytes */%d' % len(CONTENT)})
+            return
+        self.send(206, CONTENT[offset:],
+                  {'Content-Range': 'bytes %d-%d/%d' % (offset, len(CONTENT) - 1, len(CONTENT))})
+
+    def send(self, status, body, headers=None):
+        self.send_response(status)
+        self.send_header('ETag', self.etag)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FileDownloaderTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), FileHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.url = 'http://127.0.0.1:%d/file.bin' % cls.server.server_address[1]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.previousDirectory = os.getcwd()
+        self.directory = tempfile.mkdtemp()
+        os.chdir(self.directory)
+        del FileHandler.ranges[:]
+        FileHandler.etag = '"v1"'
+
+        self.localFile = os.path.join(self.directory, 'files.slack.com', 'file.bin')
+        self.manifest = AttachmentManifest()
+        self.manifest.record('F1', 'url_private', self.url, self.localFile, 'room/2020-01-01.json', True)
+        session = requests.Session()
+        self.addCleanup(session.close)
+        self.downloader = FileDownloader(session, {}, RetryPolicy(max_attempts=1, base_delay=0), 5,
+                                         workers=1, manifest=self.manifest)
+        self.addCleanup(self.downloader.executor.shutdown)
+
+    def tearDown(self):
+        os.chdir(self.previousDirectory)
+        shutil.rmtree(self.directory)
+
+    # what an interrupted download leaves behind
+    def leavePart(self, data, etag='"v1"'):
+        os.makedirs(os.path.dirname(self.localFile), exist_ok=True)
+        with open(self.localFile + '.part', 'wb') as part:
+            part.write(data)
+        self.manifest.setEtag(self.localFile, etag)
+
+    def assertDownloaded(self):
+        with open(self.localFile, 'rb') as inFile:
+            self.assertEqual(inFile.read(), CONTENT)
+        self.assertFalse(os.path.exists(self.localFile + '.part'))
+        self.assertEqual((self.downloader.downloaded, self.downloader.failed), (1, 0))
+
+    def test_partial_file_is_resumed(self):
+        self.leavePart(CONTENT[:5000])
+        self.downloader.fetch(self.url, self.localFile, len(CONTENT))
+
+        self.assertDownloaded()
+        self.assertEqual(FileHandler.ranges, ['bytes=5000-'])
+        self.assertEqual(self.downloader.downloadedBytes, len(CONTENT) - 5000)
+
+    def test_changed_file_is_fetched_whole(self):
+        self.leavePart(b'x' * 5000)
+        FileHandler.etag = '"v2"'
+        self.downloader.fetch(self.url, self.localFile, len(CONTENT))
+
+        self.assertDownloaded()
+        self.assertEqual(self.manifest.etag(self.localFile), '"v2"')
+
+    def test_complete_part_file_of_known_size_is_kept(self):
+        self.leavePart(CONTENT)
+        self.downloader.fetch(self.url, self.localFile, len(CONTENT))
+
+        self.assertDownloaded()
+        self.assertEqual(FileHandler.ranges, ['bytes=%d-' % len(CONTENT)])
+
+    def test_part_file_of_unknown_size_is_fetched_again_after_416(self):
+        for part in (CONTENT, CONTENT + b'junk'):
+            with self.subTest(partSize=len(part)):
+                del FileHandler.ranges[:]
+                self.downloader.downloaded = 0
+                self.leavePart(part)
+                self.downloader.fetch(self.url, self.localFile, None)
+
+                self.assertDownloaded()
+                self.assertEqual(FileHandler.ranges, ['bytes=%d-' % len(part), None])
+                os.remove(self.localFile)
+
+    def test_short_download_does_not_leave_a_part_file(self):
+        self.leavePart(CONTENT[:5000])
+        self.downloader.fetch(self.url, self.localFile, len(CONTENT) + 1)
+
+        self.assertFalse(os.path.exists(self.localFile))
+        self.assertFalse(os.path.exists(self.localFile + '.part'))
+        self.assertEqual(self.downloader.failed, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+import collections
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import slack_export
+from slack_export import ExternalSorter, parseMessages, parseSortedMessages, readMessageFile
+
+DAY = 86400
+FIRST_DAY = 1600000000 - 1600000000 % DAY
+
+
+# Pages as iterHistory returns them: newest page first, each sorted by 'ts',
+# with thread replies that land on days newer than the page itself.
+def historyPages(days=30, messagesPerDay=10, repliesPerDay=4):
+    generator = random.Random(0)
+    pages = []
+    for day in reversed(range(days)):
+        page = [{'ts': '%d.%06d' % (FIRST_DAY + day * DAY + index * 600, index), 'text': 'message'}
+                for index in range(messagesPerDay)]
+        page += [{'ts': '%d.%06d' % (FIRST_DAY + generator.randint(day, days - 1) * DAY + 80000,
+                                     generator.randint(0, 999999)),
+                  'text': 'reply'}
+                 for _ in range(repliesPerDay)]
+        pages.append(sorted(page, key=lambda message: message['ts']))
+    return pages
+
+
+# Checks that writing day files as pages stream in gives the same files as
+# sorting the whole history first (--spillMessages), late replies included.
+class ParseMessagesTest(unittest.TestCase):
+    def setUp(self):
+        self.previousDirectory = os.getcwd()
+        self.directory = tempfile.mkdtemp()
+        os.chdir(self.directory)
+        self.previousFormat = slack_export.outputFormat
+        slack_export.attachmentManifest = slack_export.AttachmentManifest()
+
+        self.writes = collections.Counter()
+        writeMessageFile = slack_export.writeMessageFile
+
+        def countedWrite(fileName, messages, merge=False):
+            self.writes[fileName] += 1
+            writeMessageFile(fileName, messages, merge)
+
+        slack_export.writeMessageFile = countedWrite
+        self.addCleanup(setattr, slack_export, 'writeMessageFile', writeMessageFile)
+
+    def tearDown(self):
+        slack_export.outputFormat = self.previousFormat
+        os.chdir(self.previousDirectory)
+        shutil.rmtree(self.directory)
+
+    def dayFiles(self, roomDir):
+        return {fileName: readMessageFile(os.path.join(roomDir, fileName))
+                for fileName in sorted(os.listdir(roomDir))}
+
+    def spilled(self, roomDir, pages):
+        sorter = ExternalSorter(maxMessages=25, directory='spill')
+        for page in pages:
+            sorter.add(page)
+        self.assertGreater(len(sorter.runs), 1)
+        parseSortedMessages(roomDir, sorter.sortedMessages())
+
+    def test_streamed_and_spilled_day_files_are_identical(self):
+        for outputFormat in ('viewer', 'jsonl'):
+            with self.subTest(outputFormat=outputFormat):
+                slack_export.outputFormat = outputFormat
+                pages = historyPages()
+                parseMessages(outputFormat + '-streamed', pages)
+                self.spilled(outputFormat + '-spilled', pages)
+
+                streamed = self.dayFiles(outputFormat + '-streamed')
+                self.assertEqual(len(streamed), 30)
+                self.assertEqual(streamed, self.dayFiles(outputFormat + '-spilled'))
+
+                messages = [message for dayMessages in streamed.values() for message in dayMessages]
+                self.assertEqual(messages, sorted((message for page in pages for message in page),
+                                                  key=lambda message: message['ts']))
+
+    def test_late_replies_rewrite_a_day_file_once(self):
+        parseMessages('room', historyPages())
+
+        self.assertEqual(len(self.writes), 30)
+        self.assertEqual(max(self.writes.values()), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
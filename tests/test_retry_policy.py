@@ -0,0 +1,101 @@
+import os
+import sys
+import time
+import unittest
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from slacker import RetryPolicy
+
+
+class Response(object):
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+# Returns the given responses (or raises the given exceptions) one attempt at
+# a time, and records the timeout of every attempt.
+class Attempts(object):
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.timeouts = []
+
+    def __call__(self, timeout):
+        self.timeouts.append(timeout)
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+
+def policy(**kwargs):
+    kwargs.setdefault('base_delay', 0)
+    return RetryPolicy(**kwargs)
+
+
+class RetryPolicyTest(unittest.TestCase):
+    def test_transient_failures_are_retried(self):
+        attempts = Attempts(Response(502), requests.exceptions.ConnectionError(), Response(200))
+        retryPolicy = policy(max_attempts=3)
+
+        self.assertEqual(retryPolicy.call(attempts).status_code, 200)
+        self.assertEqual(retryPolicy.report()['retries'], 2)
+
+    def test_other_statuses_are_not_retried(self):
+        attempts = Attempts(Response(404))
+
+        self.assertEqual(policy().call(attempts).status_code, 404)
+        self.assertEqual(len(attempts.timeouts), 1)
+
+    def test_last_response_or_exception_after_the_last_attempt(self):
+        self.assertEqual(policy(max_attempts=2).call(Attempts(Response(503), Response(504))).status_code, 504)
+        with self.assertRaises(requests.exceptions.Timeout):
+            policy(max_attempts=2).call(Attempts(Response(503), requests.exceptions.Timeout()))
+
+    def test_every_attempt_gets_a_longer_timeout(self):
+        attempts = Attempts(Response(500), Response(500), Response(500), Response(200))
+        policy(max_attempts=4, timeout_growth=2, max_timeout=30).call(attempts, timeout=10)
+
+        self.assertEqual(attempts.timeouts, [10, 20, 30, 30])
+
+    def test_retry_after_is_honoured(self):
+        self.assertEqual(policy().delay(0, Response(503, {'retry-after': '7'})), 7.0)
+        self.assertLessEqual(policy(base_delay=1, max_delay=3).delay(5), 3)
+
+    def test_retries_stop_when_the_budget_is_spent(self):
+        retryPolicy = policy(max_attempts=10, budget=2, budget_ratio=0.5)
+        attempts = Attempts(*[Response(502)] * 3)
+
+        self.assertEqual(retryPolicy.call(attempts).status_code, 502)
+        self.assertEqual(len(attempts.timeouts), 3)
+        self.assertEqual(retryPolicy.report()['give_ups'], 1)
+
+        # two successes earn one retry back
+        retryPolicy.call(Attempts(Response(200)))
+        retryPolicy.call(Attempts(Response(200)))
+        attempts = Attempts(Response(502), Response(502))
+        retryPolicy.call(attempts)
+        self.assertEqual(len(attempts.timeouts), 2)
+
+    def test_consecutive_failures_open_the_circuit(self):
+        retryPolicy = policy(max_attempts=1, breaker_threshold=3, breaker_reset=0.2)
+        for _ in range(3):
+            retryPolicy.call(Attempts(Response(500)))
+        self.assertEqual(retryPolicy.report()['breaker_trips'], 1)
+
+        started = time.monotonic()
+        self.assertEqual(retryPolicy.call(Attempts(Response(200))).status_code, 200)
+        self.assertGreaterEqual(time.monotonic() - started, 0.15)
+
+    def test_a_success_resets_the_failure_count(self):
+        retryPolicy = policy(max_attempts=1, breaker_threshold=3)
+        for outcome in (500, 500, 200, 500, 500):
+            retryPolicy.call(Attempts(Response(outcome)))
+        self.assertEqual(retryPolicy.report()['breaker_trips'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()